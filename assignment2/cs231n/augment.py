@@ -0,0 +1,120 @@
+import numpy as np
+
+"""
+This file implements data augmentation for minibatches of images. Every
+function works on a whole minibatch X of shape (N, C, H, W) at once with
+vectorized numpy operations, draws an independent random transformation for
+each image, modifies X in place and returns it:
+
+def augment(X, ..., rng=np.random):
+
+Inputs:
+  - X: A float numpy array of shape (N, C, H, W) giving a minibatch of images.
+  - rng: A numpy RandomState (or the np.random module) used to draw the
+    random transformations.
+
+Returns:
+  - X: The same array, holding the augmented images.
+
+The Augmenter class chains these functions; pass an instance as the transform
+of a DataLoader (or to a Solver) so that augmentation runs in the background
+prefetching thread.
+"""
+
+
+def random_crop(X, pad, rng=np.random):
+  """
+  Zero-pad each image by pad pixels on every side and take a random crop of
+  the original size, which translates the image by up to pad pixels in each
+  direction.
+  """
+  N, C, H, W = X.shape
+  X_padded = np.pad(X, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  dy = rng.randint(0, 2 * pad + 1, size=N)
+  dx = rng.randint(0, 2 * pad + 1, size=N)
+  rows = dy[:, np.newaxis] + np.arange(H)
+  cols = dx[:, np.newaxis] + np.arange(W)
+  X[...] = X_padded[np.arange(N)[:, None, None, None],
+                    np.arange(C)[None, :, None, None],
+                    rows[:, None, :, None],
+                    cols[:, None, None, :]]
+  return X
+
+
+def random_flip(X, rng=np.random):
+  """
+  Mirror each image horizontally with probability 1/2.
+  """
+  flip = rng.rand(X.shape[0]) < 0.5
+  X[flip] = X[flip, :, :, ::-1]
+  return X
+
+
+def color_jitter(X, brightness=0.0, contrast=0.0, rng=np.random):
+  """
+  Randomly change the brightness and contrast of each image.
+
+  The contrast of each image is scaled by a factor drawn uniformly from
+  [1 - contrast, 1 + contrast] around its mean value, and then an offset drawn
+  uniformly from [-brightness, brightness] is added to every pixel.
+  """
+  N = X.shape[0]
+  if contrast > 0:
+    scale = rng.uniform(1 - contrast, 1 + contrast, size=N).astype(X.dtype)
+    scale = scale[:, None, None, None]
+    mean = X.mean(axis=(1, 2, 3), keepdims=True)
+    X -= mean
+    X *= scale
+    X += mean
+  if brightness > 0:
+    shift = rng.uniform(-brightness, brightness, size=N).astype(X.dtype)
+    X += shift[:, None, None, None]
+  return X
+
+
+class Augmenter(object):
+  """
+  An Augmenter applies random crops, horizontal flips and color jitter to
+  minibatches of images. It is called with a float minibatch X of shape
+  (N, C, H, W), modifies it in place and returns it.
+
+  Example usage:
+
+  augment = Augmenter(pad=4, flip=True, brightness=10, contrast=0.2)
+  loader = DataLoader(data['X_train'], data['y_train'], transform=augment)
+  """
+
+  def __init__(self, pad=0, flip=False, brightness=0.0, contrast=0.0,
+               seed=None):
+    """
+    Construct a new Augmenter.
+
+    Inputs:
+    - pad: Maximum translation in pixels for random crops; 0 disables them.
+    - flip: If True, randomly mirror images horizontally.
+    - brightness: Maximum offset added to all pixels of an image.
+    - contrast: Maximum relative change in the contrast of an image.
+    - seed: Seed for the random number generator used to augment. If None,
+      it is drawn from the global numpy random state, so np.random.seed()
+      makes the augmentations reproducible.
+    """
+    self.pad = pad
+    self.flip = flip
+    self.brightness = brightness
+    self.contrast = contrast
+    if seed is None:
+      seed = np.random.randint(2**31 - 1)
+    self.rng = np.random.RandomState(seed)
+
+
+  def __call__(self, X):
+    # Augmentations modify X in place, which needs a float array; with raw
+    # uint8 pixels pass a mean to the DataLoader so that it converts them.
+    assert np.issubdtype(X.dtype, np.floating), 'Augmenter needs float data'
+    if self.pad > 0:
+      random_crop(X, self.pad, rng=self.rng)
+    if self.flip:
+      random_flip(X, rng=self.rng)
+    if self.brightness > 0 or self.contrast > 0:
+      color_jitter(X, self.brightness, self.contrast, rng=self.rng)
+    return X
@@ -14,6 +14,10 @@ class ThreeLayerConvNet(object):
   The network operates on minibatches of data that have shape (N, C, H, W)
   consisting of N images, each with height H and width W and with C input
   channels.
+
+  The hidden affine layer has num_filters * H/2 * W/2 inputs. If you want a
+  much smaller and faster model, try global_avg_pool_forward (layers.py)
+  after the pool; the hidden affine layer then only has num_filters inputs.
   """
   
   def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
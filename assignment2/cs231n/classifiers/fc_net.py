@@ -150,7 +150,8 @@ class TwoLayerNet(object):
     dfirst_affine_out = relu_backward(dfirst_relu_out, first_relu_cache)
     
     # first_affine_out, first_affine_cache = affine_forward(X, W1, b1)
-    first_affine_out_bp = affine_backward(dfirst_affine_out, first_affine_cache)
+    first_affine_out_bp = affine_backward(dfirst_affine_out, first_affine_cache,
+                                          compute_dx=False)
     dW1 += first_affine_out_bp[1]
     db1 = first_affine_out_bp[2]
     
@@ -266,7 +267,7 @@ class FullyConnectedNet(object):
       self.dropout_param['mode'] = mode   
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
 
     scores = None
     ############################################################################
@@ -310,3 +311,36 @@ class FullyConnectedNet(object):
     ############################################################################
 
     return loss, grads
+
+
+  def folded_for_inference(self):
+    """
+    Build an inference-only copy of this network in which every batch
+    normalization layer has been folded into the affine layer before it using
+    the running means and variances, so that test-time forward passes run no
+    batch normalization at all.
+
+    This relies on the parameters being stored as described in __init__ (W1,
+    b1, gamma1, beta1, ...), so it only works once __init__ and loss have been
+    implemented.
+
+    Returns:
+    - model: A FullyConnectedNet without batch normalization or dropout that
+      computes the same test-time scores as this one.
+    """
+    hidden_dims = [self.params['W%d' % (i + 1)].shape[1]
+                   for i in xrange(self.num_layers - 1)]
+    input_dim = self.params['W1'].shape[0]
+    num_classes = self.params['W%d' % self.num_layers].shape[1]
+    model = FullyConnectedNet(hidden_dims, input_dim=input_dim,
+                              num_classes=num_classes, reg=self.reg,
+                              dtype=self.dtype)
+
+    for i in xrange(1, self.num_layers + 1):
+      W, b = self.params['W%d' % i], self.params['b%d' % i]
+      if self.use_batchnorm and i < self.num_layers:
+        W, b = fold_batchnorm(W, b, self.params['gamma%d' % i],
+                              self.params['beta%d' % i], self.bn_params[i - 1])
+      model.params['W%d' % i] = W.copy()
+      model.params['b%d' % i] = b.copy()
+    return model
@@ -0,0 +1,196 @@
+import threading
+from Queue import Queue
+
+import numpy as np
+
+
+class DataLoader(object):
+  """
+  A DataLoader produces minibatches of training data for a Solver. Each epoch
+  visits the training set in a fresh random order, and minibatches are
+  assembled ahead of time by a background thread so that copying data
+  overlaps with the forward and backward passes of the model.
+
+  Data augmentation can be done in the same background thread by passing a
+  transform such as an Augmenter from augment.py.
+
+  Minibatches are written into a small ring of preallocated buffers, so no
+  memory is allocated per iteration. The arrays returned by next() are views
+  of one of these buffers and are only valid until the following call to
+  next(); copy them if you need to keep them around.
+
+  Example usage might look something like this:
+
+  loader = DataLoader(data['X_train'], data['y_train'], batch_size=100)
+  for t in xrange(num_iterations):
+    X_batch, y_batch = loader.next()
+    loss, grads = model.loss(X_batch, y_batch)
+  loader.close()
+  """
+
+  def __init__(self, X, y, batch_size=100, shuffle=True, num_prefetch=2,
+               mean=None, transform=None, seed=None):
+    """
+    Construct a new DataLoader.
+
+    Inputs:
+    - X: Array of shape (N, d_1, ..., d_k) giving the data. This can be a
+      memory-mapped array; rows are only read when they are batched.
+    - y: Array of shape (N,) giving labels for X.
+    - batch_size: Number of examples per minibatch. If there are fewer than
+      batch_size examples, every minibatch holds all of them.
+    - shuffle: If True, visit the data in a new random order each epoch;
+      otherwise visit it in order.
+    - num_prefetch: Number of minibatches to prepare ahead of time in the
+      background thread. If 0, minibatches are built synchronously in next().
+    - mean: If not None, X holds raw (typically uint8) pixels and mean is an
+      array of shape (d_1, ..., d_k). Each minibatch is then converted to
+      float32 and centered by subtracting mean as it is gathered, so the full
+      dataset never has to be stored as floats.
+    - transform: If not None, a function applied to every X_batch after it
+      is gathered, such as an Augmenter from augment.py. It runs in the
+      background thread and must modify X_batch in place.
+    - seed: Seed for the random number generator used to shuffle. If None,
+      it is drawn from the global numpy random state, so np.random.seed()
+      makes the order of minibatches reproducible.
+    """
+    self.X = X
+    self.y = y
+    self.batch_size = min(batch_size, X.shape[0])
+    self.shuffle = shuffle
+    self.num_prefetch = num_prefetch
+    self.mean = mean
+    self.transform = transform
+    if seed is None:
+      seed = np.random.randint(2**31 - 1)
+    self.rng = np.random.RandomState(seed)
+
+    # Number of full minibatches per epoch; leftover examples are dropped
+    # and get their turn in a later epoch since the order changes.
+    self.num_batches = X.shape[0] // self.batch_size
+
+    num_buffers = num_prefetch + 1
+    batch_shape = (self.batch_size,) + X.shape[1:]
+    dtype = X.dtype
+    self._raw_buffer = None
+    if mean is not None:
+      dtype = np.float32
+      self.mean = mean.astype(dtype)
+      self._raw_buffer = np.empty(batch_shape, dtype=X.dtype)
+    self._X_buffers = [np.empty(batch_shape, dtype=dtype)
+                       for i in xrange(num_buffers)]
+    self._y_buffers = [np.empty(self.batch_size, dtype=y.dtype)
+                       for i in xrange(num_buffers)]
+    self._thread = None
+    self._indices = None
+    self._current = None
+
+
+  def _batch_indices(self):
+    """
+    Generator yielding the sorted row indices of every minibatch, epoch after
+    epoch. Sorting within a minibatch does not change its contents but makes
+    the gather read the source array in memory order.
+    """
+    N = self.X.shape[0]
+    while True:
+      order = self.rng.permutation(N) if self.shuffle else np.arange(N)
+      for i in xrange(self.num_batches):
+        idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+        idx.sort()
+        yield idx
+
+
+  def _fill(self, slot, idx):
+    """
+    Gather the rows idx of X and y into the buffers at position slot, then
+    center them and apply the transform, if any.
+    """
+    if self.mean is None:
+      np.take(self.X, idx, axis=0, out=self._X_buffers[slot])
+    else:
+      # Only one minibatch is gathered at a time, so one raw buffer suffices
+      np.take(self.X, idx, axis=0, out=self._raw_buffer)
+      np.subtract(self._raw_buffer, self.mean, out=self._X_buffers[slot])
+    np.take(self.y, idx, axis=0, out=self._y_buffers[slot])
+    if self.transform is not None:
+      self.transform(self._X_buffers[slot])
+
+
+  def _produce(self):
+    """
+    Body of the background thread: fill free buffers until told to stop.
+    Any error is handed to the consumer, which raises it from next().
+    """
+    try:
+      for idx in self._indices:
+        slot = self._free.get()
+        if slot is None:
+          return
+        self._fill(slot, idx)
+        self._ready.put(slot)
+    except Exception as e:
+      self._ready.put(e)
+
+
+  def _start(self):
+    """
+    Set up the buffer queues and start the background thread.
+    """
+    self._indices = self._batch_indices()
+    self._current = None
+    if self.num_prefetch == 0:
+      return
+    self._free = Queue()
+    self._ready = Queue()
+    for slot in xrange(len(self._X_buffers)):
+      self._free.put(slot)
+    self._thread = threading.Thread(target=self._produce)
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def next(self):
+    """
+    Return the next minibatch as a tuple (X_batch, y_batch) of shapes
+    (batch_size, d_1, ..., d_k) and (batch_size,).
+    """
+    if self._indices is None:
+      self._start()
+
+    if self.num_prefetch == 0:
+      self._fill(0, next(self._indices))
+      return self._X_buffers[0], self._y_buffers[0]
+
+    # The caller is done with the previous minibatch, so its buffer can be
+    # refilled while the next one is in use.
+    if self._current is not None:
+      self._free.put(self._current)
+    slot = self._ready.get()
+    if isinstance(slot, Exception):
+      # The background thread has stopped; shut down cleanly so that the
+      # next call starts over instead of waiting for it forever.
+      self.close()
+      raise slot
+    self._current = slot
+    return self._X_buffers[slot], self._y_buffers[slot]
+
+  __next__ = next
+
+
+  def __iter__(self):
+    return self
+
+
+  def close(self):
+    """
+    Stop the background thread. Calling next() afterwards starts over with a
+    fresh epoch.
+    """
+    if self._thread is not None:
+      # The producer stops once it reaches this marker in the free queue
+      self._free.put(None)
+      self._thread.join()
+      self._thread = None
+    self._indices = None
+    self._current = None
@@ -1,65 +1,130 @@
 import cPickle as pickle
+import json
+import multiprocessing
 import numpy as np
 import os
+import struct
 from scipy.misc import imread
 
 def load_CIFAR_batch(filename):
-  """ load single batch of cifar """
+  """ load single batch of cifar as raw uint8 pixels of shape (N, 3, 32, 32) """
   with open(filename, 'rb') as f:
     datadict = pickle.load(f)
     X = datadict['data']
     Y = datadict['labels']
-    X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+    X = X.reshape(-1, 3, 32, 32)
     Y = np.array(Y)
     return X, Y
 
-def load_CIFAR10(ROOT):
-  """ load all of cifar """
+
+def _save_array(filename, arr):
+  """
+  Write arr to the .npy file filename. The data is written to a temporary
+  file first and then renamed, so an interrupted write never leaves behind a
+  file that looks like a complete cache entry.
+  """
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    np.save(f, arr)
+  os.rename(tmp_filename, filename)
+
+
+def _build_CIFAR10_cache(ROOT, cache_dir):
+  """
+  Decode the pickled CIFAR-10 batches in ROOT once and write them to cache_dir
+  as uint8 .npy files that can later be memory-mapped.
+  """
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
   xs = []
   ys = []
   for b in range(1,6):
     f = os.path.join(ROOT, 'data_batch_%d' % (b, ))
     X, Y = load_CIFAR_batch(f)
     xs.append(X)
-    ys.append(Y)    
-  Xtr = np.concatenate(xs)
-  Ytr = np.concatenate(ys)
-  del X, Y
+    ys.append(Y)
+  _save_array(os.path.join(cache_dir, 'X_train.npy'), np.concatenate(xs))
+  _save_array(os.path.join(cache_dir, 'y_train.npy'), np.concatenate(ys))
+  del xs, ys
   Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'))
+  _save_array(os.path.join(cache_dir, 'X_test.npy'), Xte)
+  _save_array(os.path.join(cache_dir, 'y_test.npy'), Yte)
+
+
+def load_CIFAR10(ROOT, cache_dir=None):
+  """
+  Load all of CIFAR-10.
+
+  The first call decodes the pickled batches and writes them to a binary
+  cache; every later call just memory-maps that cache, which takes a few
+  milliseconds instead of several seconds.
+
+  Inputs:
+  - ROOT: String giving the path to the cifar-10-batches-py directory.
+  - cache_dir: Directory holding the .npy cache. Defaults to ROOT/cache.
+
+  Returns a tuple of:
+  - Xtr: Read-only memory-mapped uint8 array of shape (50000, 3, 32, 32)
+  - Ytr: Read-only memory-mapped array of shape (50000,) of labels
+  - Xte: Read-only memory-mapped uint8 array of shape (10000, 3, 32, 32)
+  - Yte: Read-only memory-mapped array of shape (10000,) of labels
+
+  The images are stored as raw pixels, so convert only the rows you need,
+  for example X_batch = Xtr[i:j].astype(np.float32).
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(ROOT, 'cache')
+  names = ['X_train', 'y_train', 'X_test', 'y_test']
+  filenames = [os.path.join(cache_dir, '%s.npy' % name) for name in names]
+  if not all(os.path.isfile(filename) for filename in filenames):
+    _build_CIFAR10_cache(ROOT, cache_dir)
+  Xtr, Ytr, Xte, Yte = [np.load(f, mmap_mode='r') for f in filenames]
   return Xtr, Ytr, Xte, Yte
 
 
-def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000):
+def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
+                     dtype=np.float64):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The raw uint8 pixels are only read once: each split is converted to dtype
+    and centered in a single pass into its output array, so the only full
+    size arrays that are ever allocated are the ones that are returned.
+
+    If dtype is np.uint8 then no conversion happens at all: the splits are
+    returned as views of the memory-mapped raw pixels, and the dictionary
+    also holds the float32 'mean_image' that a Solver subtracts from each
+    minibatch as it converts it to float32.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
     X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
         
-    # Subsample the data
-    mask = range(num_training, num_training + num_validation)
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = range(num_training)
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = range(num_test)
-    X_test = X_test[mask]
-    y_test = y_test[mask]
-
-    # Normalize the data: subtract the mean image
-    mean_image = np.mean(X_train, axis=0)
-    X_train -= mean_image
-    X_val -= mean_image
-    X_test -= mean_image
-    
-    # Transpose so that channels come first
-    X_train = X_train.transpose(0, 3, 1, 2).copy()
-    X_val = X_val.transpose(0, 3, 1, 2).copy()
-    X_test = X_test.transpose(0, 3, 1, 2).copy()
+    # Subsample the data; slices are views, so nothing is copied yet
+    X_val = X_train[num_training:num_training + num_validation]
+    y_val = np.array(y_train[num_training:num_training + num_validation])
+    X_train = X_train[:num_training]
+    y_train = np.array(y_train[:num_training])
+    X_test = X_test[:num_test]
+    y_test = np.array(y_test[:num_test])
+
+    # Normalize the data: subtract the mean image. The mean is accumulated
+    # directly from the uint8 pixels, and np.subtract casts while it writes
+    # into the output so no intermediate float copies are made.
+    mean_image = np.mean(X_train, axis=0, dtype=np.float64)
+    if np.dtype(dtype) == np.uint8:
+      return {
+        'X_train': X_train, 'y_train': y_train,
+        'X_val': X_val, 'y_val': y_val,
+        'X_test': X_test, 'y_test': y_test,
+        'mean_image': mean_image.astype(np.float32),
+      }
+    mean_image = mean_image.astype(dtype)
+    X_train = np.subtract(X_train, mean_image, out=np.empty(X_train.shape, dtype))
+    X_val = np.subtract(X_val, mean_image, out=np.empty(X_val.shape, dtype))
+    X_test = np.subtract(X_test, mean_image, out=np.empty(X_test.shape, dtype))
 
     # Package data into a dictionary
     return {
@@ -69,15 +134,67 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000):
     }
     
 
-def load_tiny_imagenet(path, dtype=np.float32):
+def _decode_images_into(args):
+  """
+  Worker for _decode_images: decode a list of image files and write them into
+  consecutive rows of the .npy file array_filename, starting at row start.
+  """
+  array_filename, start, img_files = args
+  X = np.load(array_filename, mmap_mode='r+')
+  for i, img_file in enumerate(img_files):
+    img = imread(img_file)
+    if img.ndim == 2:
+      ## grayscale file
+      img.shape = (64, 64, 1)
+    X[start + i] = img.transpose(2, 0, 1)
+  X.flush()
+  del X
+  return len(img_files)
+
+
+def _decode_images(img_files, array_filename, num_workers=None, chunk_size=256):
+  """
+  Decode a list of 64x64 images with a pool of worker processes.
+
+  The images are written straight into a preallocated uint8 .npy file of shape
+  (len(img_files), 3, 64, 64) that every worker memory-maps, so no decoded
+  pixels are ever sent between processes. The file is renamed to
+  array_filename only once every image has been written.
+  """
+  tmp_filename = array_filename + '.tmp'
+  X = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=np.uint8,
+                                shape=(len(img_files), 3, 64, 64))
+  del X
+
+  jobs = [(tmp_filename, i, img_files[i:i + chunk_size])
+          for i in xrange(0, len(img_files), chunk_size)]
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    pool.map(_decode_images_into, jobs)
+  finally:
+    pool.close()
+    pool.join()
+  os.rename(tmp_filename, array_filename)
+
+
+def load_tiny_imagenet(path, dtype=np.float32, num_workers=None, cache_dir=None):
   """
   Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
   TinyImageNet-200 have the same directory structure, so this can be used
   to load any of them.
 
+  The first call decodes every JPEG in parallel using num_workers processes
+  and caches the decoded pixels as uint8 .npy files in cache_dir; later calls
+  memory-map the cache instead of decoding anything.
+
   Inputs:
   - path: String giving path to the directory to load.
-  - dtype: numpy datatype used to load the data.
+  - dtype: numpy datatype used to load the data. If this is np.uint8 then the
+    returned images are read-only memory-mapped views of the cache and
+    loading is nearly instant.
+  - num_workers: Number of decoding processes; defaults to the number of CPUs.
+  - cache_dir: Directory holding the decoded images. Defaults to path/cache.
+    Delete it if the contents of path change.
 
   Returns: A tuple of
   - class_names: A list where class_names[i] is a list of strings giving the
@@ -104,63 +221,53 @@ def load_tiny_imagenet(path, dtype=np.float32):
       wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
   class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-  # Next load training data.
-  X_train = []
+  # Next list the training data. To figure out the filenames we need to open
+  # the boxes file of each synset.
+  train_files = []
   y_train = []
-  for i, wnid in enumerate(wnids):
-    if (i + 1) % 20 == 0:
-      print 'loading training data for synset %d / %d' % (i + 1, len(wnids))
-    # To figure out the filenames we need to open the boxes file
+  for wnid in wnids:
     boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
     with open(boxes_file, 'r') as f:
       filenames = [x.split('\t')[0] for x in f]
-    num_images = len(filenames)
-    
-    X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-    y_train_block = wnid_to_label[wnid] * np.ones(num_images, dtype=np.int64)
-    for j, img_file in enumerate(filenames):
-      img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        ## grayscale file
-        img.shape = (64, 64, 1)
-      X_train_block[j] = img.transpose(2, 0, 1)
-    X_train.append(X_train_block)
-    y_train.append(y_train_block)
-      
-  # We need to concatenate all training data
-  X_train = np.concatenate(X_train, axis=0)
-  y_train = np.concatenate(y_train, axis=0)
-  
-  # Next load validation data
+    train_files.extend(os.path.join(path, 'train', wnid, 'images', img_file)
+                       for img_file in filenames)
+    y_train.extend([wnid_to_label[wnid]] * len(filenames))
+  y_train = np.array(y_train, dtype=np.int64)
+
+  # Next list the validation data
   with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-    img_files = []
+    val_files = []
     val_wnids = []
     for line in f:
       img_file, wnid = line.split('\t')[:2]
-      img_files.append(img_file)
+      val_files.append(os.path.join(path, 'val', 'images', img_file))
       val_wnids.append(wnid)
-    num_val = len(img_files)
     y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-    X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-      img_file = os.path.join(path, 'val', 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        img.shape = (64, 64, 1)
-      X_val[i] = img.transpose(2, 0, 1)
-
-  # Next load test images
+
+  # Next list the test images
   # Students won't have test labels, so we need to iterate over files in the
-  # images directory.
-  img_files = os.listdir(os.path.join(path, 'test', 'images'))
-  X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-  for i, img_file in enumerate(img_files):
-    img_file = os.path.join(path, 'test', 'images', img_file)
-    img = imread(img_file)
-    if img.ndim == 2:
-      img.shape = (64, 64, 1)
-    X_test[i] = img.transpose(2, 0, 1)
+  # images directory. Sort them so the order matches the cache across runs.
+  img_files = sorted(os.listdir(os.path.join(path, 'test', 'images')))
+  test_files = [os.path.join(path, 'test', 'images', img_file)
+                for img_file in img_files]
+
+  # Decode any split that is not cached yet, then map the cached pixels
+  if cache_dir is None:
+    cache_dir = os.path.join(path, 'cache')
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  splits = []
+  for name, files in [('train', train_files), ('val', val_files),
+                      ('test', test_files)]:
+    array_filename = os.path.join(cache_dir, 'X_%s.npy' % name)
+    if not os.path.isfile(array_filename):
+      print 'decoding %d %s images' % (len(files), name)
+      _decode_images(files, array_filename, num_workers=num_workers)
+    X = np.load(array_filename, mmap_mode='r')
+    if np.dtype(dtype) != np.uint8:
+      X = X.astype(dtype)
+    splits.append(X)
+  X_train, X_val, X_test = splits
 
   y_test = None
   y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
@@ -176,24 +283,177 @@ def load_tiny_imagenet(path, dtype=np.float32):
   return class_names, X_train, y_train, X_val, y_val, X_test, y_test
 
 
-def load_models(models_dir):
+# Model files start with this magic string, followed by the length of a JSON
+# header as a little-endian uint32, the header itself, and then the raw bytes
+# of every array. The header maps each parameter name to its dtype, shape and
+# byte offset in the file; offsets are multiples of _MODEL_ALIGN.
+_MODEL_MAGIC = 'CS231N\x00\x01'
+_MODEL_ALIGN = 64
+_MODEL_INDEX = 'index.json'
+
+
+def save_model(filename, params):
   """
-  Load saved models from disk. This will attempt to unpickle all files in a
-  directory; any files that give errors on unpickling (such as README.txt) will
-  be skipped.
+  Save the parameters of a model to disk in a format that load_model can
+  memory-map, and record the model in the index of its directory.
 
   Inputs:
-  - models_dir: String giving the path to a directory containing model files.
-    Each model file is a pickled dictionary with a 'model' field.
+  - filename: String giving the path of the model file to write.
+  - params: Dictionary mapping parameter names to numpy arrays, such as the
+    params attribute of a model.
+  """
+  arrays = {}
+  names = sorted(params)
+  # The header size depends on the offsets, so lay out the arrays assuming a
+  # generously sized header and grow it until everything fits.
+  header_size = _MODEL_ALIGN
+  while True:
+    offset = header_size
+    for name in names:
+      v = params[name]
+      arrays[name] = {'dtype': v.dtype.str, 'shape': list(v.shape),
+                      'offset': offset}
+      offset += -(-v.nbytes // _MODEL_ALIGN) * _MODEL_ALIGN
+    header = json.dumps({'arrays': arrays}, sort_keys=True)
+    if len(_MODEL_MAGIC) + 4 + len(header) <= header_size:
+      break
+    header_size *= 2
+
+  # Write to a temporary file first so that a model being loaded never sees a
+  # partially written file
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    f.write(_MODEL_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for name in names:
+      f.seek(arrays[name]['offset'])
+      np.ascontiguousarray(params[name]).tofile(f)
+    f.truncate(offset)
+  os.rename(tmp_filename, filename)
+
+  _update_model_index(os.path.dirname(filename) or '.')
+
+
+def _read_model_header(filename):
+  """
+  Read the header of a model file, returning its dictionary of array layouts,
+  or None if the file is not a model file. Raises ValueError if the header is
+  truncated or malformed, or if the arrays it describes run past the end of
+  the file.
+  """
+  with open(filename, 'rb') as f:
+    if f.read(len(_MODEL_MAGIC)) != _MODEL_MAGIC:
+      return None
+    file_size = os.fstat(f.fileno()).st_size
+    try:
+      header_len, = struct.unpack('<I', f.read(4))
+      arrays = json.loads(f.read(header_len))['arrays']
+      for layout in arrays.itervalues():
+        nbytes = (np.dtype(str(layout['dtype'])).itemsize *
+                  int(np.prod(layout['shape'])))
+        if layout['offset'] + nbytes > file_size:
+          raise ValueError('array runs past the end of the file')
+    except (struct.error, ValueError, KeyError, TypeError, AttributeError) as e:
+      raise ValueError('"%s" is not a valid model file: %s' % (filename, e))
+  return arrays
+
+
+def _map_model(filename, arrays):
+  """
+  Memory-map the arrays of a model file given the layouts from its header.
+  Nothing is read from disk until the arrays are used.
+  """
+  data = np.memmap(filename, dtype=np.uint8, mode='r')
+  params = {}
+  for name, layout in arrays.iteritems():
+    params[str(name)] = np.ndarray(tuple(layout['shape']),
+                                   dtype=np.dtype(str(layout['dtype'])),
+                                   buffer=data, offset=layout['offset'])
+  return params
+
+
+def load_model(filename):
+  """
+  Load the parameters of a model saved with save_model.
 
   Returns:
-  A dictionary mapping model file names to models.
+  A dictionary mapping parameter names to read-only memory-mapped arrays.
   """
-  models = {}
+  arrays = _read_model_header(filename)
+  if arrays is None:
+    raise ValueError('"%s" is not a model file' % filename)
+  return _map_model(filename, arrays)
+
+
+def _update_model_index(models_dir):
+  """
+  Rebuild the index of models_dir, which records the header of every model
+  file together with its size and modification time. Headers of files that
+  are unchanged since the last index are reused rather than read again.
+
+  Returns the index as a dictionary mapping model file names to entries.
+  """
+  index_file = os.path.join(models_dir, _MODEL_INDEX)
+  old_index = {}
+  if os.path.isfile(index_file):
+    try:
+      with open(index_file, 'r') as f:
+        old_index = json.load(f)
+    except (IOError, OSError, ValueError):
+      # An unreadable index just means every header is read again
+      pass
+
+  index = {}
   for model_file in os.listdir(models_dir):
-    with open(os.path.join(models_dir, model_file), 'rb') as f:
+    path = os.path.join(models_dir, model_file)
+    if (model_file == _MODEL_INDEX or model_file.endswith('.tmp') or
+        not os.path.isfile(path)):
+      continue
+    st = os.stat(path)
+    entry = old_index.get(model_file)
+    if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
       try:
-        models[model_file] = pickle.load(f)['model']
-      except pickle.UnpicklingError:
+        arrays = _read_model_header(path)
+      except ValueError:
+        # Truncated or malformed model files are skipped like other files
+        arrays = None
+      if arrays is None:
         continue
+      entry = {'size': st.st_size, 'mtime': st.st_mtime, 'arrays': arrays}
+    index[model_file] = entry
+
+  if index != old_index:
+    # Writing the index is only an optimization, so loading still works from
+    # a read-only directory. The temporary file is named after the process so
+    # that concurrent loaders do not clobber each other's writes.
+    tmp_filename = '%s.%d.tmp' % (index_file, os.getpid())
+    try:
+      with open(tmp_filename, 'w') as f:
+        json.dump(index, f, sort_keys=True)
+      os.rename(tmp_filename, index_file)
+    except (IOError, OSError):
+      pass
+  return index
+
+
+def load_models(models_dir):
+  """
+  Load saved models from disk. This uses the index of models_dir to find every
+  model file written by save_model and memory-maps their parameters, so it
+  takes about the same time no matter how large the models are. Other files
+  in the directory (such as README.txt) are skipped; nothing is unpickled.
+
+  Inputs:
+  - models_dir: String giving the path to a directory containing model files.
+
+  Returns:
+  A dictionary mapping model file names to dictionaries of parameters, as
+  returned by load_model.
+  """
+  index = _update_model_index(models_dir)
+  models = {}
+  for model_file, entry in index.iteritems():
+    path = os.path.join(models_dir, model_file)
+    models[str(model_file)] = _map_model(path, entry['arrays'])
   return models
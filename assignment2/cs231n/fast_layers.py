@@ -1,13 +1,83 @@
+import json
+import os
+import time
+
 import numpy as np
 try:
   from cs231n.im2col_cython import col2im_cython, im2col_cython
   from cs231n.im2col_cython import col2im_6d_cython
+  from cs231n.im2col_cython import conv_forward_direct_cython
+  from cs231n.im2col_cython import conv_backward_direct_cython
+  from cs231n.im2col_cython import max_pool_argmax_cython
+  from cs231n.im2col_cython import max_pool_scatter_cython
 except ImportError:
   print 'run the following from the cs231n directory and try again:'
   print 'python setup.py build_ext --inplace'
   print 'You may also need to restart your iPython kernel'
 
 from cs231n.im2col import *
+from cs231n.layers import conv_backward_naive, _windows
+
+
+def _cols_for_cache(x_cols, conv_param):
+  """
+  Prepare the im2col matrix x_cols for storage in a conv cache according to
+  conv_param['cache_mode']:
+  - 'full' (default): Keep x_cols as it is.
+  - 'recompute': Drop x_cols; the backward pass rebuilds it from x.
+  - 'float16': Keep a half precision copy of x_cols, which takes a quarter of
+    the memory of float64. The gradient dw is then computed from values
+    rounded to about 3 significant digits.
+
+  x_cols has C * HH * WW times as many elements as the output of the layer
+  has positions, so for large filters dropping it from the cache is what lets
+  larger minibatches fit in memory.
+  """
+  cache_mode = conv_param.get('cache_mode', 'full')
+  if cache_mode == 'full':
+    return x_cols
+  elif cache_mode == 'recompute':
+    return None
+  elif cache_mode == 'float16':
+    return x_cols.astype(np.float16)
+  else:
+    raise ValueError('Invalid conv cache_mode "%s"' % cache_mode)
+
+
+def _cols_from_cache(x_cols, x, build_cols):
+  """
+  Inverse of _cols_for_cache: return the im2col matrix with the dtype of x,
+  calling build_cols() to rebuild it if it was not kept.
+  """
+  if x_cols is None:
+    return build_cols()
+  return x_cols.astype(x.dtype, copy=False)
+
+
+def _im2col_strides(x, HH, WW, pad, stride):
+  """
+  Build the im2col matrix for x by copying from a strided view of the padded
+  input. Columns are ordered by (n, i, j), so the result has shape
+  (C * HH * WW, N * out_h * out_w).
+  """
+  N, C, H, W = x.shape
+  p = pad
+  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+
+  H += 2 * pad
+  W += 2 * pad
+  out_h = (H - HH) // stride + 1
+  out_w = (W - WW) // stride + 1
+
+  # Perform an im2col operation by picking clever strides
+  shape = (C, HH, WW, N, out_h, out_w)
+  strides = (H * W, W, 1, C * H * W, stride * W, stride)
+  strides = x.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                shape=shape, strides=strides)
+  x_cols = np.ascontiguousarray(x_stride)
+  x_cols.shape = (C * HH * WW, N * out_h * out_w)
+  return x_cols
 
 
 def conv_forward_im2col(x, w, b, conv_param):
@@ -35,7 +105,7 @@ def conv_forward_im2col(x, w, b, conv_param):
   out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
   out = out.transpose(3, 0, 1, 2)
 
-  cache = (x, w, b, conv_param, x_cols)
+  cache = (x, w, b, conv_param, _cols_for_cache(x_cols, conv_param))
   return out, cache
 
 
@@ -48,24 +118,11 @@ def conv_forward_strides(x, w, b, conv_param):
   assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
   assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
-  # Pad the input
-  p = pad
-  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-  
   # Figure out output dimensions
-  H += 2 * pad
-  W += 2 * pad
-  out_h = (H - HH) / stride + 1
-  out_w = (W - WW) / stride + 1
+  out_h = (H + 2 * pad - HH) // stride + 1
+  out_w = (W + 2 * pad - WW) // stride + 1
 
-  # Perform an im2col operation by picking clever strides
-  shape = (C, HH, WW, N, out_h, out_w)
-  strides = (H * W, W, 1, C * H * W, stride * W, stride)
-  strides = x.itemsize * np.array(strides)
-  x_stride = np.lib.stride_tricks.as_strided(x_padded,
-                shape=shape, strides=strides)
-  x_cols = np.ascontiguousarray(x_stride)
-  x_cols.shape = (C * HH * WW, N * out_h * out_w)
+  x_cols = _im2col_strides(x, HH, WW, pad, stride)
 
   # Now all our convolutions are a big matrix multiply
   res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
@@ -79,7 +136,7 @@ def conv_forward_strides(x, w, b, conv_param):
   # comparison we won't either
   out = np.ascontiguousarray(out)
 
-  cache = (x, w, b, conv_param, x_cols)
+  cache = (x, w, b, conv_param, _cols_for_cache(x_cols, conv_param))
   return out, cache
   
 
@@ -93,6 +150,8 @@ def conv_backward_strides(dout, cache):
 
   db = np.sum(dout, axis=(0, 2, 3))
 
+  x_cols = _cols_from_cache(x_cols, x,
+                            lambda: _im2col_strides(x, HH, WW, pad, stride))
   dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
   dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
@@ -114,6 +173,8 @@ def conv_backward_im2col(dout, cache):
   db = np.sum(dout, axis=(0, 2, 3))
 
   num_filters, _, filter_height, filter_width = w.shape
+  x_cols = _cols_from_cache(x_cols, x, lambda: im2col_cython(
+      x, filter_height, filter_width, pad, stride))
   dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
   dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
@@ -125,18 +186,408 @@ def conv_backward_im2col(dout, cache):
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+def conv_forward_direct(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer that
+  computes the convolution directly in Cython, without an im2col matrix.
+  This pays off when there are few input channels, as in the first layer.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  # Check dimensions
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  out = conv_forward_direct_cython(x, w.astype(x.dtype, copy=False),
+                                   b.astype(x.dtype, copy=False), pad, stride)
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def conv_backward_direct(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer that
+  computes the convolution directly in Cython.
+  """
+  x, w, b, conv_param = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  dx, dw = conv_backward_direct_cython(dout.astype(x.dtype, copy=False), x,
+                                       w.astype(x.dtype, copy=False), pad, stride)
+  return dx, dw, db
+
+
+# Filter transform for Winograd's minimal filtering algorithm F(2x2, 3x3),
+# which computes each 2x2 output tile from a 4x4 input tile with 16 multiplies
+# per channel instead of 36; see Lavin and Gray, "Fast Algorithms for
+# Convolutional Neural Networks". The input and output transforms only add
+# and subtract, so they are written out in _winograd_input_transform and
+# conv_forward_winograd instead of as matrices.
+_WINOGRAD_G = np.array([[1, 0, 0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+
+
+def _winograd_input_transform(d, out):
+  """
+  Compute out = BT d B for Winograd F(2x2, 3x3), where d has shape
+  (4, 4, ...) and holds the 4x4 input tiles along its first two axes. The
+  result is written to out, which has the same shape as d.
+  """
+  t = np.empty_like(out)
+  for dst, src in ((t, d), (out.swapaxes(0, 1), t.swapaxes(0, 1))):
+    np.subtract(src[0], src[2], out=dst[0])
+    np.add(src[1], src[2], out=dst[1])
+    np.subtract(src[2], src[1], out=dst[2])
+    np.subtract(src[1], src[3], out=dst[3])
+  return out
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer with
+  3x3 filters and stride 1 based on Winograd's F(2x2, 3x3) algorithm.
+
+  The input is cut into overlapping 4x4 tiles that each produce a 2x2 output
+  tile. After transforming tiles and filters, the convolution becomes 16
+  independent (F, C) x (C, tiles) matrix multiplies, which need 2.25x fewer
+  multiplies than the direct method and no im2col matrix.
+
+  The cache is the same as for conv_forward_naive, whose backward pass is used.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert HH == WW == 3 and stride == 1, 'Winograd needs 3x3 filters, stride 1'
+
+  out_h = H + 2 * pad - 2
+  out_w = W + 2 * pad - 2
+  tiles_h = (out_h + 1) // 2
+  tiles_w = (out_w + 1) // 2
+
+  # Pad the input, plus an extra row / column of zeros if needed so that the
+  # tiles cover an even-sized output
+  x_padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2), dtype=x.dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  s0, s1, s2, s3 = x_padded.strides
+  tiles = np.lib.stride_tricks.as_strided(x_padded,
+              shape=(4, 4, C, N, tiles_h, tiles_w),
+              strides=(s2, s3, s1, s0, 2 * s2, 2 * s3))
+
+  # Input transform BT d B, laid out as (16, C, N * tiles_h * tiles_w)
+  V = np.empty(tiles.shape, dtype=x.dtype)
+  _winograd_input_transform(tiles, V)
+  V.shape = (16, C, -1)
+
+  # Filter transform G g GT, laid out as (16, F, C)
+  G = _WINOGRAD_G.astype(w.dtype)
+  U = np.tensordot(G, w, axes=([1], [2]))
+  U = np.tensordot(U, G, axes=([3], [1]))
+  U = U.transpose(0, 3, 1, 2).reshape(16, F, C)
+
+  # Elementwise products in the transformed domain, summed over channels
+  M = np.matmul(U, V).reshape(4, 4, F, N, tiles_h, tiles_w)
+
+  # Output transform AT m A, written straight into the 2x2 output tiles
+  out = np.empty((N, F, tiles_h, 2, tiles_w, 2), dtype=M.dtype)
+  t = np.empty((2, 4, F, N, tiles_h, tiles_w), dtype=M.dtype)
+  y = out.transpose(3, 5, 1, 0, 2, 4)
+  for dst, src in ((t, M), (y.swapaxes(0, 1), t.swapaxes(0, 1))):
+    np.add(src[0], src[1], out=dst[0])
+    dst[0] += src[2]
+    np.subtract(src[1], src[2], out=dst[1])
+    dst[1] -= src[3]
+  out.shape = (N, F, 2 * tiles_h, 2 * tiles_w)
+  if out_h % 2 or out_w % 2:
+    out = np.ascontiguousarray(out[:, :, :out_h, :out_w])
+  out += b.reshape(F, 1, 1)
+
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer with
+  3x3 filters and stride 1 based on Winograd's F(2x2, 3x3) algorithm.
+  """
+  x, w, b, conv_param = cache
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  pad = conv_param['pad']
+  if pad > 2:
+    return conv_backward_naive(dout, cache)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  windows = _windows(x_padded, HH, WW, 1)
+  dw = np.tensordot(dout, windows, axes=([0, 2, 3], [0, 2, 3]))
+
+  # dx is the full convolution of dout with the filters, which is itself a
+  # 3x3 stride 1 convolution of dout with the flipped filters, with the roles
+  # of filters and channels swapped.
+  w_flipped = w[:, :, ::-1, ::-1].transpose(1, 0, 2, 3)
+  dx, _ = conv_forward_winograd(dout, w_flipped, np.zeros(C, dtype=dout.dtype),
+                                {'stride': 1, 'pad': 2 - pad})
+
+  return dx, dw, db
+
+
+def _fft_channel_product(A, B):
+  """
+  Given arrays A of shape (P, Q, h, w) and B of shape (Q, R, h, w) holding
+  2D spectra, return the array of shape (P, R, h, w) whose [p, r] element is
+  the sum over q of A[p, q] * B[q, r], computed as one batched matrix multiply
+  per frequency.
+  """
+  P, Q, h, w = A.shape
+  R = B.shape[1]
+  A = A.transpose(2, 3, 0, 1).reshape(h * w, P, Q)
+  B = B.transpose(2, 3, 0, 1).reshape(h * w, Q, R)
+  return np.matmul(A, B).reshape(h, w, P, R).transpose(2, 3, 0, 1)
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer with
+  stride 1 based on the FFT.
+
+  Each channel of the padded input and each filter is transformed once, so
+  the cost hardly depends on the filter size; this makes it the fastest
+  choice for large filters such as 7x7.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert stride == 1, 'FFT convolution needs stride 1'
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  H_padded, W_padded = x_padded.shape[2:]
+  size = (H_padded, W_padded)
+
+  # Correlating with w is convolving with w flipped; the valid outputs start
+  # at (HH - 1, WW - 1) and do not wrap around.
+  X = np.fft.rfft2(x_padded)
+  Wf = np.fft.rfft2(w[:, :, ::-1, ::-1], s=size)
+  out = np.fft.irfft2(_fft_channel_product(X, Wf.transpose(1, 0, 2, 3)), s=size)
+  out = out[:, :, HH - 1:, WW - 1:].astype(x.dtype)
+  out += b.reshape(F, 1, 1)
+
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+def conv_backward_fft(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer with
+  stride 1 based on the FFT.
+  """
+  x, w, b, conv_param = cache
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  pad = conv_param['pad']
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  size = x_padded.shape[2:]
+  X = np.fft.rfft2(x_padded)
+  D = np.fft.rfft2(dout, s=size)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  # dw is the correlation of the input with dout, and dx is the full
+  # convolution of dout with w; neither wraps around within the padded size.
+  dW = _fft_channel_product(np.conj(D).transpose(1, 0, 2, 3), X)
+  dw = np.fft.irfft2(dW, s=size)[:, :, :HH, :WW].astype(w.dtype)
+
+  dX = _fft_channel_product(D, np.fft.rfft2(w, s=size))
+  dx = np.fft.irfft2(dX, s=size)[:, :, pad:pad + H, pad:pad + W].astype(x.dtype)
+
+  return dx, dw, db
+
+
+# Convolution implementations that conv_forward_fast chooses from, as
+# (name, forward, backward) tuples; the forward and backward of each must
+# share a cache format.
+_CONV_IMPLEMENTATIONS = [
+  ('strides', conv_forward_strides, conv_backward_strides),
+  ('im2col', conv_forward_im2col, conv_backward_im2col),
+  ('direct', conv_forward_direct, conv_backward_direct),
+  ('winograd', conv_forward_winograd, conv_backward_winograd),
+  ('fft', conv_forward_fft, conv_backward_fft),
+]
+_CONV_FORWARD = dict((name, f) for name, f, _ in _CONV_IMPLEMENTATIONS)
+_CONV_BACKWARD = dict((name, b) for name, _, b in _CONV_IMPLEMENTATIONS)
+
+# conv_forward_fast benchmarks every implementation the first time it sees a
+# new combination of shapes and remembers the fastest one in this file, so
+# the choice is shared between processes on the same machine. Set this to
+# None to only remember choices for the lifetime of the process, or set
+# conv_autotune to False to choose by shape without benchmarking at all.
+conv_autotune_file = os.path.join(os.path.expanduser('~'), '.cs231n',
+                                  'conv_autotune.json')
+conv_autotune = True
+_conv_choices = None
+
+
+def _conv_key(x, w, conv_param):
+  """
+  Key identifying the convolutions for which one implementation is chosen.
+  """
+  return 'x=%s w=%s stride=%d pad=%d dtype=%s cache=%s' % (
+      'x'.join(map(str, x.shape)), 'x'.join(map(str, w.shape)),
+      conv_param['stride'], conv_param['pad'], x.dtype.name,
+      conv_param.get('cache_mode', 'full'))
+
+
+def _load_conv_choices():
+  """
+  Read the choices saved in conv_autotune_file. A missing or unreadable file
+  just means that everything is benchmarked again.
+  """
+  if conv_autotune_file is None:
+    return {}
+  try:
+    with open(conv_autotune_file, 'r') as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+
+
+def _save_conv_choice(key, name):
+  """
+  Add one choice to conv_autotune_file. Choices saved by other processes in
+  the meantime are kept, and the file is replaced atomically so that readers
+  never see a partial write.
+  """
+  if conv_autotune_file is None:
+    return
+  try:
+    dirname = os.path.dirname(conv_autotune_file)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    choices = _load_conv_choices()
+    choices[key] = name
+    tmp_filename = '%s.%d.tmp' % (conv_autotune_file, os.getpid())
+    with open(tmp_filename, 'w') as f:
+      json.dump(choices, f, indent=2, sort_keys=True)
+    os.rename(tmp_filename, conv_autotune_file)
+  except (IOError, OSError):
+    # Not being able to save only costs another benchmark next time
+    pass
+
+
+def _conv_heuristic(x, w, conv_param):
+  """
+  Choose a convolution implementation from the shapes alone. With stride 1
+  and enough input channels for the arithmetic to dominate, 3x3 filters use
+  Winograd's algorithm and 5x5 or larger filters use the FFT; everything else
+  uses the strides implementation.
+  """
+  _, C, HH, WW = w.shape
+  if conv_param['stride'] == 1 and C >= 16:
+    if HH == WW == 3:
+      return 'winograd'
+    if min(HH, WW) >= 5:
+      return 'fft'
+  return 'strides'
+
+
+def _conv_benchmark(x, w, b, conv_param, num_trials=2):
+  """
+  Time the forward and backward pass of every applicable convolution
+  implementation on these inputs.
+
+  Returns a tuple of:
+  - name: Name of the fastest implementation.
+  - out, cache: Output of its forward pass, so that the benchmarked call does
+    not have to be repeated.
+  """
+  best_name, best_time, best_result = None, None, None
+  error = None
+  for name, forward, backward in _CONV_IMPLEMENTATIONS:
+    elapsed = None
+    try:
+      for t in xrange(num_trials):
+        start = time.time()
+        out, cache = forward(x, w, b, conv_param)
+        backward(np.ones_like(out), cache)
+        trial_time = time.time() - start
+        if elapsed is None or trial_time < elapsed:
+          elapsed = trial_time
+    except (AssertionError, NameError) as e:
+      # The implementation does not support these shapes, or it needs the
+      # Cython extension and that has not been built
+      error = e
+      continue
+    if best_time is None or elapsed < best_time:
+      best_name, best_time, best_result = name, elapsed, (out, cache)
+  if best_name is None:
+    raise error
+  return best_name, best_result[0], best_result[1]
+
+
+def conv_forward_fast(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer.
+
+  This dispatches to whichever implementation is fastest on this machine for
+  the shapes involved. The first call for new shapes benchmarks all of them
+  (see conv_autotune_file); later calls just look up the choice.
+
+  conv_param may also contain 'cache_mode' to trade compute or precision in
+  the backward pass for a smaller cache; see _cols_for_cache.
+  """
+  global _conv_choices
+  # Every implementation needs the filters to tile the padded input; check
+  # here so that the error is the same whichever one would be chosen.
+  _, _, H, W = x.shape
+  _, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  if not conv_autotune:
+    name = _conv_heuristic(x, w, conv_param)
+  else:
+    if _conv_choices is None:
+      _conv_choices = _load_conv_choices()
+    key = _conv_key(x, w, conv_param)
+    name = _conv_choices.get(key)
+    if name not in _CONV_FORWARD:
+      name, out, real_cache = _conv_benchmark(x, w, b, conv_param)
+      _conv_choices[key] = name
+      _save_conv_choice(key, name)
+      return out, (name, real_cache)
+  out, real_cache = _CONV_FORWARD[name](x, w, b, conv_param)
+  return out, (name, real_cache)
+
+
+def conv_backward_fast(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer.
+
+  This switches between implementations depending on which one was used to
+  generate the cache.
+  """
+  method, real_cache = cache
+  if method not in _CONV_BACKWARD:
+    raise ValueError('Unrecognized method "%s"' % method)
+  return _CONV_BACKWARD[method](dout, real_cache)
 
 
 def max_pool_forward_fast(x, pool_param):
   """
   A fast implementation of the forward pass for a max pooling layer.
 
-  This chooses between the reshape method and the im2col method. If the pooling
-  regions are square and tile the input image, then we can use the reshape
-  method which is very fast. Otherwise we fall back on the im2col method, which
-  is not much faster than the naive method.
+  This chooses between the reshape method and the argmax method. If the
+  pooling regions are square and tile the input image, then we can use the
+  reshape method which is very fast. Otherwise, for example for overlapping
+  3x3 regions with stride 2, we use the compiled argmax method.
   """
   N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -148,8 +599,8 @@ def max_pool_forward_fast(x, pool_param):
     out, reshape_cache = max_pool_forward_reshape(x, pool_param)
     cache = ('reshape', reshape_cache)
   else:
-    out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-    cache = ('im2col', im2col_cache)
+    out, argmax_cache = max_pool_forward_argmax(x, pool_param)
+    cache = ('argmax', argmax_cache)
   return out, cache
 
 
@@ -157,12 +608,14 @@ def max_pool_backward_fast(dout, cache):
   """
   A fast implementation of the backward pass for a max pooling layer.
 
-  This switches between the reshape method an the im2col method depending on
+  This switches between the reshape, argmax and im2col methods depending on
   which method was used to generate the cache.
   """
   method, real_cache = cache
   if method == 'reshape':
     return max_pool_backward_reshape(dout, real_cache)
+  elif method == 'argmax':
+    return max_pool_backward_argmax(dout, real_cache)
   elif method == 'im2col':
     return max_pool_backward_im2col(dout, real_cache)
   else:
@@ -175,58 +628,105 @@ def max_pool_forward_reshape(x, pool_param):
   some clever reshaping.
 
   This can only be used for square pooling regions that tile the input.
+
+  Rather than the input, the cache holds the position of each maximum within
+  its pooling region as a uint8 offset (int32 for regions of more than 256
+  elements), like max_pool_forward_argmax, which is a small fraction of the
+  size of x.
   """
   N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
   stride = pool_param['stride']
   assert pool_height == pool_width == stride, 'Invalid pool params'
   assert H % pool_height == 0
-  assert W % pool_height == 0
-  x_reshaped = x.reshape(N, C, H / pool_height, pool_height,
-                         W / pool_width, pool_width)
-  out = x_reshaped.max(axis=3).max(axis=4)
-
-  cache = (x, x_reshaped, out)
+  assert W % pool_width == 0
+  out_h, out_w = H // pool_height, W // pool_width
+  pool_size = pool_height * pool_width
+
+  # Gather the elements of each pooling region next to each other
+  x_reshaped = x.reshape(N, C, out_h, pool_height, out_w, pool_width)
+  x_windows = x_reshaped.transpose(0, 1, 2, 4, 3, 5).reshape(-1, pool_size)
+  argmax = np.argmax(x_windows, axis=1)
+  out = np.take(x_windows.ravel(), np.arange(0, x_windows.size, pool_size) + argmax)
+  out = out.reshape(N, C, out_h, out_w)
+
+  index_dtype = np.uint8 if pool_size <= 256 else np.int32
+  cache = (x.shape, argmax.astype(index_dtype).reshape(out.shape), pool_param)
   return out, cache
 
 
 def max_pool_backward_reshape(dout, cache):
   """
   A fast implementation of the backward pass for the max pooling layer that
-  uses some clever broadcasting and reshaping.
+  scatters the upstream gradient directly to the cached argmax positions.
 
   This can only be used if the forward pass was computed using
   max_pool_forward_reshape.
 
-  NOTE: If there are multiple argmaxes, this method will assign gradient to
-  ALL argmax elements of the input rather than picking one. In this case the
-  gradient will actually be incorrect. However this is unlikely to occur in
-  practice, so it shouldn't matter much. One possible solution is to split the
-  upstream gradient equally among all argmax elements; this should result in a
-  valid subgradient. You can make this happen by uncommenting the line below;
-  however this results in a significant performance penalty (about 40% slower)
-  and is unlikely to matter in practice so we don't do it.
-  """
-  x, x_reshaped, out = cache
-
-  dx_reshaped = np.zeros_like(x_reshaped)
-  out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
-  mask = (x_reshaped == out_newaxis)
-  dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
-  dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
-  dx_reshaped[mask] = dout_broadcast[mask]
-  dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
-  dx = dx_reshaped.reshape(x.shape)
+  NOTE: If there are multiple argmaxes, all of the gradient goes to the first
+  one in row-major order, as in the naive implementation. This is a valid
+  subgradient and makes the result deterministic.
+  """
+  x_shape, argmax, pool_param = cache
+  N, C, H, W = x_shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  _, _, out_h, out_w = argmax.shape
 
+  # Flat index into dx of the top-left corner of every pooling region, plus
+  # the offset of the maximum within the region
+  corners = np.arange(N * C * out_h).reshape(-1, 1) * (pool_height * W)
+  corners = corners + np.arange(out_w) * pool_width
+  offsets = argmax.reshape(-1, out_w).astype(np.intp)
+  indices = corners + (offsets // pool_width) * W + offsets % pool_width
+
+  dx = np.zeros(x_shape, dtype=dout.dtype)
+  dx.ravel()[indices.ravel()] = dout.ravel()
   return dx
 
 
+def max_pool_forward_argmax(x, pool_param):
+  """
+  A fast implementation of the forward pass for max pooling that works for
+  any pooling regions, including overlapping ones. A compiled kernel computes
+  the maxima and records the position of each within its pooling region as a
+  small integer (uint8 for regions of up to 256 elements), so the cache is a
+  fraction of the size of the input.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  assert (H - pool_height) % stride == 0, 'Invalid height'
+  assert (W - pool_width) % stride == 0, 'Invalid width'
+
+  out, argmax = max_pool_argmax_cython(x, pool_height, pool_width, stride)
+
+  cache = (x.shape, argmax, pool_param)
+  return out, cache
+
+
+def max_pool_backward_argmax(dout, cache):
+  """
+  A fast implementation of the backward pass for max pooling that scatters
+  each upstream gradient directly to the position of its maximum.
+
+  This can only be used if the forward pass was computed using
+  max_pool_forward_argmax.
+  """
+  x_shape, argmax, pool_param = cache
+  N, C, H, W = x_shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  return max_pool_scatter_cython(dout, argmax, H, W, pool_height, pool_width,
+                                 stride)
+
+
 def max_pool_forward_im2col(x, pool_param):
   """
   An implementation of the forward pass for max pooling based on im2col.
 
-  This isn't much faster than the naive version, so it should be avoided if
-  possible.
+  This only needs numpy, but max_pool_forward_argmax is faster.
   """
   N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -235,11 +735,12 @@ def max_pool_forward_im2col(x, pool_param):
   assert (H - pool_height) % stride == 0, 'Invalid height'
   assert (W - pool_width) % stride == 0, 'Invalid width'
 
-  out_height = (H - pool_height) / stride + 1
-  out_width = (W - pool_width) / stride + 1
+  out_height = (H - pool_height) // stride + 1
+  out_width = (W - pool_width) // stride + 1
 
   x_split = x.reshape(N * C, 1, H, W)
-  x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+  x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0,
+                          stride=stride)
   x_cols_argmax = np.argmax(x_cols, axis=0)
   x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
   out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
@@ -252,8 +753,7 @@ def max_pool_backward_im2col(dout, cache):
   """
   An implementation of the backward pass for max pooling based on im2col.
 
-  This isn't much faster than the naive version, so it should be avoided if
-  possible.
+  This only needs numpy, but max_pool_backward_argmax is faster.
   """
   x, x_cols, x_cols_argmax, pool_param = cache
   N, C, H, W = x.shape
@@ -268,3 +768,93 @@ def max_pool_backward_im2col(dout, cache):
   dx = dx.reshape(x.shape)
 
   return dx
+
+
+def avg_pool_forward_fast(x, pool_param):
+  """
+  A fast implementation of the forward pass for an average pooling layer.
+
+  If the pooling regions are square and tile the input image, every region is
+  averaged with a single reshape. Otherwise the sum over each region is read
+  off a 2D cumulative sum of the input (an integral image) from its four
+  corners, which costs the same for any region size or stride.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  same_size = pool_height == pool_width == stride
+  tiles = H % pool_height == 0 and W % pool_width == 0
+  if same_size and tiles:
+    x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
+                           W // pool_width, pool_width)
+    out = x_reshaped.mean(axis=(3, 5))
+    method = 'reshape'
+  else:
+    assert (H - pool_height) % stride == 0, 'Invalid height'
+    assert (W - pool_width) % stride == 0, 'Invalid width'
+    out_h = (H - pool_height) // stride + 1
+    out_w = (W - pool_width) // stride + 1
+
+    # S[:, :, i, j] is the sum of x[:, :, :i, :j]; sums are accumulated in
+    # float64 so that large images do not lose precision.
+    S = np.zeros((N, C, H + 1, W + 1))
+    np.cumsum(x, axis=2, dtype=np.float64, out=S[:, :, 1:, 1:])
+    np.cumsum(S[:, :, 1:, 1:], axis=3, out=S[:, :, 1:, 1:])
+
+    top = slice(0, stride * out_h, stride)
+    bottom = slice(pool_height, pool_height + stride * out_h, stride)
+    left = slice(0, stride * out_w, stride)
+    right = slice(pool_width, pool_width + stride * out_w, stride)
+    sums = (S[:, :, bottom, right] - S[:, :, top, right]
+            - S[:, :, bottom, left] + S[:, :, top, left])
+    out = (sums / (pool_height * pool_width)).astype(x.dtype)
+    method = 'cumsum'
+
+  cache = (method, (x.shape, pool_param))
+  return out, cache
+
+
+def avg_pool_backward_fast(dout, cache):
+  """
+  A fast implementation of the backward pass for an average pooling layer.
+
+  For the cumsum method with large pooling regions, the share of the
+  gradient of each region is added at its top-left and bottom-right corners
+  and subtracted at the other two; a 2D cumulative sum then spreads it over
+  exactly the region. For small regions it is cheaper to add the shares with
+  one strided add per position within the region.
+  """
+  method, (x_shape, pool_param) = cache
+  N, C, H, W = x_shape
+  _, _, out_h, out_w = dout.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  dout_share = dout / float(pool_height * pool_width)
+
+  if method == 'reshape':
+    dx = np.empty((N, C, out_h, pool_height, out_w, pool_width), dtype=dout.dtype)
+    dx[...] = dout_share[:, :, :, np.newaxis, :, np.newaxis]
+    return dx.reshape(x_shape)
+  elif method == 'cumsum' and pool_height * pool_width <= 32:
+    dx = np.zeros(x_shape, dtype=dout.dtype)
+    for i in xrange(pool_height):
+      for j in xrange(pool_width):
+        dx[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += \
+            dout_share
+    return dx
+  elif method == 'cumsum':
+    top = slice(0, stride * out_h, stride)
+    bottom = slice(pool_height, pool_height + stride * out_h, stride)
+    left = slice(0, stride * out_w, stride)
+    right = slice(pool_width, pool_width + stride * out_w, stride)
+    D = np.zeros((N, C, H + 1, W + 1))
+    D[:, :, top, left] += dout_share
+    D[:, :, top, right] -= dout_share
+    D[:, :, bottom, left] -= dout_share
+    D[:, :, bottom, right] += dout_share
+    np.cumsum(D, axis=2, out=D)
+    np.cumsum(D, axis=3, out=D)
+    return D[:, :, :H, :W].astype(dout.dtype)
+  else:
+    raise ValueError('Unrecognized method "%s"' % method)
@@ -1,25 +1,85 @@
+from collections import OrderedDict
+
 import numpy as np
 
 
+# Index tables depend only on shapes, so they are built once and kept in a
+# small least-recently-used cache instead of being rebuilt on every call. The
+# cache holds at most _INDEX_CACHE_SIZE tables taking at most
+# _INDEX_CACHE_BYTES bytes, except that the latest table is always kept.
+_INDEX_CACHE_SIZE = 16
+_INDEX_CACHE_BYTES = 256 * 1024 * 1024
+_index_cache = OrderedDict()
+
+
+def _cached(key, build):
+  """
+  Return the value stored in the index cache under key, calling build() to
+  create it on a miss. The arrays are made read-only since they are shared by
+  every caller.
+  """
+  if key in _index_cache:
+    value = _index_cache.pop(key)
+  else:
+    value = build()
+    for arr in value:
+      arr.setflags(write=False)
+  # (Re)inserting the key marks it as the most recently used
+  _index_cache[key] = value
+
+  while len(_index_cache) > 1:
+    num_bytes = sum(arr.nbytes for v in _index_cache.itervalues() for arr in v)
+    if len(_index_cache) <= _INDEX_CACHE_SIZE and num_bytes <= _INDEX_CACHE_BYTES:
+      break
+    _index_cache.popitem(last=False)
+  return value
+
+
 def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
   # First figure out what the size of the output should be
   N, C, H, W = x_shape
   assert (H + 2 * padding - field_height) % stride == 0
-  assert (W + 2 * padding - field_height) % stride == 0
-  out_height = (H + 2 * padding - field_height) / stride + 1
-  out_width = (W + 2 * padding - field_width) / stride + 1
+  assert (W + 2 * padding - field_width) % stride == 0
+  out_height = (H + 2 * padding - field_height) // stride + 1
+  out_width = (W + 2 * padding - field_width) // stride + 1
+
+  def build():
+    i0 = np.repeat(np.arange(field_height), field_width)
+    i0 = np.tile(i0, C)
+    i1 = stride * np.repeat(np.arange(out_height), out_width)
+    j0 = np.tile(np.arange(field_width), field_height * C)
+    j1 = stride * np.tile(np.arange(out_width), out_height)
+    i = i0.reshape(-1, 1) + i1.reshape(1, -1)
+    j = j0.reshape(-1, 1) + j1.reshape(1, -1)
 
-  i0 = np.repeat(np.arange(field_height), field_width)
-  i0 = np.tile(i0, C)
-  i1 = stride * np.repeat(np.arange(out_height), out_width)
-  j0 = np.tile(np.arange(field_width), field_height * C)
-  j1 = stride * np.tile(np.arange(out_width), out_height)
-  i = i0.reshape(-1, 1) + i1.reshape(1, -1)
-  j = j0.reshape(-1, 1) + j1.reshape(1, -1)
+    k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
+
+    return (k, i, j)
+
+  # The tables do not depend on the number of images N
+  key = ('im2col', C, H, W, field_height, field_width, padding, stride)
+  return _cached(key, build)
+
+
+def get_col2im_indices(x_shape, field_height, field_width, padding=1, stride=1):
+  """
+  Return an array with the same shape as the matrix produced by im2col_indices
+  for an input of shape x_shape, giving for each of its elements the flat
+  index into the zero-padded input that it was copied from.
+  """
+  N, C, H, W = x_shape
+  H_padded, W_padded = H + 2 * padding, W + 2 * padding
 
-  k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
+  def build():
+    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
+                                 stride)
+    plane_indices = (k * H_padded + i) * W_padded + j
+    image_offsets = np.arange(N) * (C * H_padded * W_padded)
+    indices = plane_indices[:, :, np.newaxis] + image_offsets
+    return (indices.reshape(plane_indices.shape[0], -1),)
 
-  return (k, i, j)
+  key = ('col2im', N, C, H, W, field_height, field_width, padding, stride)
+  return _cached(key, build)[0]
 
 
 def im2col_indices(x, field_height, field_width, padding=1, stride=1):
@@ -39,15 +99,20 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
-  """ An implementation of col2im based on fancy indexing and np.add.at """
+  """
+  An implementation of col2im based on np.bincount: every element of cols is
+  added to the element of the padded input it came from, which bincount does
+  in one pass over a precomputed table of flat indices, much faster than
+  np.add.at.
+  """
   N, C, H, W = x_shape
   H_padded, W_padded = H + 2 * padding, W + 2 * padding
-  x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-  k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
+  indices = get_col2im_indices(x_shape, field_height, field_width, padding,
                                stride)
-  cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-  cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-  np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
+  x_padded = np.bincount(indices.ravel(), weights=cols.ravel(),
+                         minlength=N * C * H_padded * W_padded)
+  x_padded = x_padded.astype(cols.dtype, copy=False)
+  x_padded = x_padded.reshape(N, C, H_padded, W_padded)
   if padding == 0:
     return x_padded
   return x_padded[:, :, padding:-padding, padding:-padding]
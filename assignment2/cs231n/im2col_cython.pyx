@@ -1,6 +1,8 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel import prange
+from libc.stdlib cimport calloc, free
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,113 +11,505 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+# The inner loops below release the GIL and run in parallel with OpenMP over
+# pairs of indices such as (n, c), or over the rows of cols in im2col; every
+# thread writes its own part of the output, so no two threads ever touch the
+# same element. The number of threads is
+# controlled by the OMP_NUM_THREADS environment variable. Without OpenMP (see
+# setup.py) the loops simply run serially.
+#
+# No padded copy of the input is ever made. Instead, for every filter offset
+# the loops work out which output positions read from inside the image and
+# only visit those; in im2col the remaining positions are set to zero, in
+# col2im they are dropped. im2col fills each row of cols from start to end,
+# since cols is by far the largest array; the images are read a few elements
+# at a time from each of the N images, which stays in cache. The other loops
+# visit the image of an (n, c) pair row by row in memory order.
+
+
+@cython.cdivision(True)
+cdef inline int _first_inside(int offset, int stride) nogil:
+    """
+    Smallest k >= 0 with stride * k + offset >= 0.
+    """
+    if offset >= 0:
+        return 0
+    return (stride - 1 - offset) // stride
+
+
+@cython.cdivision(True)
+cdef inline int _end_inside(int offset, int stride, int size, int count) nogil:
+    """
+    One past the largest k < count with stride * k + offset < size.
+    """
+    cdef int end
+    if offset >= size:
+        return 0
+    end = (size - 1 - offset) // stride + 1
+    if end > count:
+        return count
+    return end
+
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
+
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
 
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
+    # Every element is written by the inner loop, padding included
+    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.empty(
             (C * field_height * field_width, N * HH * WW),
             dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
-                        field_height, field_width, padding, stride)
+    # Typed memoryviews let the inner loop run without the GIL
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    with nogil:
+        im2col_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                            field_height, field_width, padding, stride)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) nogil:
+    cdef int c, ii, jj, row, yy, xx, i, y
+    cdef int y_start, y_end, x_start, x_end
+    cdef DTYPE_t *out
 
-    for c in range(C):
+    # Columns are ordered (yy, xx, n) with n fastest, so for a fixed row the
+    # loops below write out[0], out[1], ... in order.
+    for row in prange(C * field_height * field_width, schedule='static'):
+        c = row // (field_height * field_width)
+        ii = (row // field_width) % field_height
+        jj = row % field_width
+        y_end = _end_inside(ii - padding, stride, H, HH)
+        y_start = min(_first_inside(ii - padding, stride), y_end)
+        x_end = _end_inside(jj - padding, stride, W, WW)
+        x_start = min(_first_inside(jj - padding, stride), x_end)
         for yy in range(HH):
-            for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
-
+            out = &cols[row, yy * WW * N]
+            if yy < y_start or yy >= y_end:
+                for xx in range(WW * N):
+                    out[xx] = 0
+                continue
+            y = stride * yy + ii - padding
+            for xx in range(x_start * N):
+                out[xx] = 0
+            for xx in range(x_start, x_end):
+                for i in range(N):
+                    out[xx * N + i] = x[i, c, y, stride * xx + jj - padding]
+            for xx in range(x_end * N, WW * N):
+                out[xx] = 0
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
-                                        dtype=cols.dtype)
+    cdef np.ndarray[DTYPE_t, ndim=4] x = np.zeros((N, C, H, W), dtype=cols.dtype)
 
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
-                        field_height, field_width, padding, stride)
-    if padding > 0:
-        return x_padded[:, :, padding:-padding, padding:-padding]
-    return x_padded
+    cdef DTYPE_t[:, :] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    with nogil:
+        col2im_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                            field_height, field_width, padding, stride)
+    return x
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void col2im_cython_inner(DTYPE_t[:, :] cols,
+                              DTYPE_t[:, :, :, ::1] x,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) nogil:
+    cdef int nc, c, ii, jj, row, yy, xx, i, base, y
+    cdef int y_start, y_end, x_start, x_end
 
-    for c in range(C):
+    for nc in prange(N * C, schedule='static'):
+        i = nc // C
+        c = nc % C
         for ii in range(field_height):
+            y_end = _end_inside(ii - padding, stride, H, HH)
+            y_start = min(_first_inside(ii - padding, stride), y_end)
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
-                for yy in range(HH):
-                    for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                row = c * field_width * field_height + ii * field_width + jj
+                x_end = _end_inside(jj - padding, stride, W, WW)
+                x_start = min(_first_inside(jj - padding, stride), x_end)
+                for yy in range(y_start, y_end):
+                    base = yy * WW * N + i
+                    y = stride * yy + ii - padding
+                    for xx in range(x_start, x_end):
+                        x[i, c, y, stride * xx + jj - padding] += cols[row, base + xx * N]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
+@cython.cdivision(True)
+cdef void col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, :] cols,
+                                 DTYPE_t[:, :, :, ::1] x,
+                                 int N, int C, int H, int W, int HH, int WW,
+                                 int out_h, int out_w, int pad, int stride) nogil:
+
+    cdef int nc, c, hh, ww, n, h, w, y
+    cdef int h_start, h_end, w_start, w_end
+    for nc in prange(N * C, schedule='static'):
+        n = nc // C
+        c = nc % C
+        for hh in range(HH):
+            h_end = _end_inside(hh - pad, stride, H, out_h)
+            h_start = min(_first_inside(hh - pad, stride), h_end)
+            for ww in range(WW):
+                w_end = _end_inside(ww - pad, stride, W, out_w)
+                w_start = min(_first_inside(ww - pad, stride), w_end)
+                for h in range(h_start, h_end):
+                    y = stride * h + hh - pad
+                    for w in range(w_start, w_end):
+                        x[n, c, y, stride * w + ww - pad] += cols[c, hh, ww, n, h, w]
 
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
         int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int out_h = (H + 2 * pad - HH) / stride + 1
     cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
+    cdef np.ndarray[DTYPE_t, ndim=4] x = np.zeros((N, C, H, W), dtype=cols.dtype)
+
+    cdef DTYPE_t[:, :, :, :, :, :] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    with nogil:
+        col2im_6d_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                               out_h, out_w, pad, stride)
+    return x
+
+
+def conv_forward_direct_cython(np.ndarray[DTYPE_t, ndim=4] x,
+                               np.ndarray[DTYPE_t, ndim=4] w,
+                               np.ndarray[DTYPE_t, ndim=1] b,
+                               int pad, int stride):
+    """
+    Direct convolution: every output is accumulated straight from the input,
+    filter tap by filter tap, without building a column matrix. This is
+    cheapest when there are few input channels, such as in a first layer.
+    """
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[1]
+    cdef int H = x.shape[2]
+    cdef int W = x.shape[3]
+    cdef int F = w.shape[0]
+    cdef int HH = w.shape[2]
+    cdef int WW = w.shape[3]
+    cdef int out_h = (H + 2 * pad - HH) / stride + 1
+    cdef int out_w = (W + 2 * pad - WW) / stride + 1
+    cdef np.ndarray[DTYPE_t, ndim=4] out = np.empty((N, F, out_h, out_w),
+                                                    dtype=x.dtype)
+
+    cdef DTYPE_t[:, :, :, ::1] out_view = out
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    cdef DTYPE_t[:, :, :, ::1] w_view = np.ascontiguousarray(w)
+    cdef DTYPE_t[::1] b_view = np.ascontiguousarray(b)
+    with nogil:
+        conv_forward_direct_inner(out_view, x_view, w_view, b_view, N, C, H, W,
+                                  F, HH, WW, out_h, out_w, pad, stride)
+    return out
+
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void conv_forward_direct_inner(DTYPE_t[:, :, :, ::1] out,
+                                    DTYPE_t[:, :, :, ::1] x,
+                                    DTYPE_t[:, :, :, ::1] w,
+                                    DTYPE_t[::1] b,
+                                    int N, int C, int H, int W, int F,
+                                    int HH, int WW, int out_h, int out_w,
+                                    int pad, int stride) nogil:
+    cdef int nf, n, f, c, hh, ww, h, o, y
+    cdef int h_start, h_end, w_start, w_end
+    cdef DTYPE_t weight
+    cdef DTYPE_t *out_row
+    cdef DTYPE_t *x_row
+
+    # Each (n, f) pair owns one output plane and adds one shifted input plane
+    # into it per filter tap. The innermost loop runs over plain pointers to
+    # the part of one row of each that lies inside the image, with a counter
+    # starting at 0, so that the compiler can vectorize it.
+    for nf in prange(N * F, schedule='static'):
+        n = nf // F
+        f = nf % F
+        for h in range(out_h):
+            for o in range(out_w):
+                out[n, f, h, o] = b[f]
+        for c in range(C):
+            for hh in range(HH):
+                h_end = _end_inside(hh - pad, stride, H, out_h)
+                h_start = min(_first_inside(hh - pad, stride), h_end)
+                for ww in range(WW):
+                    w_end = _end_inside(ww - pad, stride, W, out_w)
+                    w_start = min(_first_inside(ww - pad, stride), w_end)
+                    weight = w[f, c, hh, ww]
+                    for h in range(h_start, h_end):
+                        y = stride * h + hh - pad
+                        out_row = &out[n, f, h, w_start]
+                        x_row = &x[n, c, y, stride * w_start + ww - pad]
+                        if stride == 1:
+                            for o in range(w_end - w_start):
+                                out_row[o] += weight * x_row[o]
+                        else:
+                            for o in range(w_end - w_start):
+                                out_row[o] += weight * x_row[stride * o]
+
+
+def conv_backward_direct_cython(np.ndarray[DTYPE_t, ndim=4] dout,
+                                np.ndarray[DTYPE_t, ndim=4] x,
+                                np.ndarray[DTYPE_t, ndim=4] w,
+                                int pad, int stride):
+    """
+    Backward pass for conv_forward_direct_cython. Returns a tuple (dx, dw).
+    """
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[1]
+    cdef int H = x.shape[2]
+    cdef int W = x.shape[3]
+    cdef int F = w.shape[0]
+    cdef int HH = w.shape[2]
+    cdef int WW = w.shape[3]
+    cdef int out_h = dout.shape[2]
+    cdef int out_w = dout.shape[3]
+    cdef np.ndarray[DTYPE_t, ndim=4] dx = np.zeros((N, C, H, W), dtype=x.dtype)
+    cdef np.ndarray[DTYPE_t, ndim=4] dw = np.empty((F, C, HH, WW), dtype=w.dtype)
+
+    cdef DTYPE_t[:, :, :, ::1] dx_view = dx
+    cdef DTYPE_t[:, :, :, ::1] dw_view = dw
+    cdef DTYPE_t[:, :, :, ::1] dout_view = np.ascontiguousarray(dout)
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    cdef DTYPE_t[:, :, :, ::1] w_view = np.ascontiguousarray(w)
+    cdef int failed
+    with nogil:
+        failed = conv_backward_direct_inner(dx_view, dw_view, dout_view, x_view,
+                                            w_view, N, C, H, W, F, HH, WW,
+                                            out_h, out_w, pad, stride)
+    if failed:
+        raise MemoryError('could not allocate the dw accumulation buffer')
+    return dx, dw
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int conv_backward_direct_inner(DTYPE_t[:, :, :, ::1] dx,
+                                     DTYPE_t[:, :, :, ::1] dw,
+                                     DTYPE_t[:, :, :, ::1] dout,
+                                     DTYPE_t[:, :, :, ::1] x,
+                                     DTYPE_t[:, :, :, ::1] w,
+                                     int N, int C, int H, int W, int F,
+                                     int HH, int WW, int out_h, int out_w,
+                                     int pad, int stride) nogil:
+    cdef int nc, fc, n, f, c, hh, ww, h, o, y
+    cdef int h_start, h_end, w_start, w_end
+    cdef DTYPE_t weight
+    cdef DTYPE_t *dx_row
+    cdef DTYPE_t *dout_row
+    cdef DTYPE_t *x_row
+    cdef DTYPE_t *sums
+    cdef DTYPE_t *sums_row
+    cdef double total
+    # Flag set by any thread that fails to allocate; writing through a
+    # pointer keeps it shared between the threads of the prange loops.
+    cdef int failed_flag = 0
+    cdef int *failed = &failed_flag
+
+    # dx: each (n, c) pair owns one input plane
+    for nc in prange(N * C, schedule='static'):
+        n = nc // C
+        c = nc % C
+        for f in range(F):
+            for hh in range(HH):
+                h_end = _end_inside(hh - pad, stride, H, out_h)
+                h_start = min(_first_inside(hh - pad, stride), h_end)
+                for ww in range(WW):
+                    w_end = _end_inside(ww - pad, stride, W, out_w)
+                    w_start = min(_first_inside(ww - pad, stride), w_end)
+                    weight = w[f, c, hh, ww]
+                    for h in range(h_start, h_end):
+                        y = stride * h + hh - pad
+                        dx_row = &dx[n, c, y, stride * w_start + ww - pad]
+                        dout_row = &dout[n, f, h, w_start]
+                        if stride == 1:
+                            for o in range(w_end - w_start):
+                                dx_row[o] += weight * dout_row[o]
+                        else:
+                            for o in range(w_end - w_start):
+                                dx_row[stride * o] += weight * dout_row[o]
+
+    # dw: each (f, c) pair owns one filter plane. Products are first summed
+    # elementwise into one row of sums per filter tap, which unlike a running
+    # scalar total can be vectorized, and each row is added up at the end.
+    for fc in prange(F * C, schedule='static'):
+        f = fc // C
+        c = fc % C
+        sums = <DTYPE_t *> calloc(HH * WW * out_w, sizeof(DTYPE_t))
+        if sums == NULL:
+            # Out of memory; the caller raises MemoryError
+            failed[0] = 1
+        else:
+            for n in range(N):
+                for hh in range(HH):
+                    h_end = _end_inside(hh - pad, stride, H, out_h)
+                    h_start = min(_first_inside(hh - pad, stride), h_end)
+                    for ww in range(WW):
+                        w_end = _end_inside(ww - pad, stride, W, out_w)
+                        w_start = min(_first_inside(ww - pad, stride), w_end)
+                        sums_row = &sums[(hh * WW + ww) * out_w]
+                        for h in range(h_start, h_end):
+                            y = stride * h + hh - pad
+                            x_row = &x[n, c, y, stride * w_start + ww - pad]
+                            dout_row = &dout[n, f, h, w_start]
+                            if stride == 1:
+                                for o in range(w_end - w_start):
+                                    sums_row[o] += dout_row[o] * x_row[o]
+                            else:
+                                for o in range(w_end - w_start):
+                                    sums_row[o] += dout_row[o] * x_row[stride * o]
+            for hh in range(HH):
+                for ww in range(WW):
+                    sums_row = &sums[(hh * WW + ww) * out_w]
+                    total = 0
+                    for o in range(out_w):
+                        total = total + sums_row[o]
+                    dw[f, c, hh, ww] = <DTYPE_t> total
+            free(sums)
+    return failed_flag
+
+
+ctypedef fused INDEX_t:
+    np.uint8_t
+    np.int32_t
+
+
+def max_pool_argmax_cython(np.ndarray[DTYPE_t, ndim=4] x, int pool_height,
+                           int pool_width, int stride):
+    """
+    Max pooling that also records where each maximum came from. Returns a
+    tuple (out, argmax) where argmax[n, c, h, w] is the offset
+    ii * pool_width + jj of the maximum within its pooling window; it is
+    stored as uint8 when windows have at most 256 elements and as int32
+    otherwise. Ties go to the first maximum in row-major order.
+    """
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[1]
+    cdef int H = x.shape[2]
+    cdef int W = x.shape[3]
+    cdef int out_h = (H - pool_height) / stride + 1
+    cdef int out_w = (W - pool_width) / stride + 1
+    cdef np.ndarray[DTYPE_t, ndim=4] out = np.empty((N, C, out_h, out_w),
+                                                    dtype=x.dtype)
+    index_dtype = np.uint8 if pool_height * pool_width <= 256 else np.int32
+    argmax = np.empty((N, C, out_h, out_w), dtype=index_dtype)
+
+    cdef DTYPE_t[:, :, :, ::1] out_view = out
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    cdef np.uint8_t[:, :, :, ::1] argmax_uint8
+    cdef np.int32_t[:, :, :, ::1] argmax_int32
+    if index_dtype == np.uint8:
+        argmax_uint8 = argmax
+        with nogil:
+            max_pool_argmax_inner(out_view, argmax_uint8, x_view, N, C,
+                                  out_h, out_w, pool_height, pool_width, stride)
+    else:
+        argmax_int32 = argmax
+        with nogil:
+            max_pool_argmax_inner(out_view, argmax_int32, x_view, N, C,
+                                  out_h, out_w, pool_height, pool_width, stride)
+    return out, argmax
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void max_pool_argmax_inner(DTYPE_t[:, :, :, ::1] out,
+                                INDEX_t[:, :, :, ::1] argmax,
+                                DTYPE_t[:, :, :, ::1] x,
+                                int N, int C, int out_h, int out_w,
+                                int pool_height, int pool_width,
+                                int stride) nogil:
+    cdef int nc, n, c, h, w, ii, jj, best_k
+    cdef DTYPE_t best, value
+
+    for nc in prange(N * C, schedule='static'):
+        n = nc // C
+        c = nc % C
+        for h in range(out_h):
+            for w in range(out_w):
+                best = x[n, c, stride * h, stride * w]
+                best_k = 0
+                for ii in range(pool_height):
+                    for jj in range(pool_width):
+                        value = x[n, c, stride * h + ii, stride * w + jj]
+                        if value > best:
+                            best = value
+                            best_k = ii * pool_width + jj
+                out[n, c, h, w] = best
+                argmax[n, c, h, w] = <INDEX_t> best_k
+
+
+def max_pool_scatter_cython(np.ndarray[DTYPE_t, ndim=4] dout, argmax,
+                            int H, int W, int pool_height, int pool_width,
+                            int stride):
+    """
+    Backward pass for max_pool_argmax_cython: route every upstream gradient to
+    the input position that produced the maximum, adding up contributions
+    where windows overlap. Returns dx of shape (N, C, H, W).
+    """
+    cdef int N = dout.shape[0]
+    cdef int C = dout.shape[1]
+    cdef int out_h = dout.shape[2]
+    cdef int out_w = dout.shape[3]
+    cdef np.ndarray[DTYPE_t, ndim=4] dx = np.zeros((N, C, H, W), dtype=dout.dtype)
+
+    cdef DTYPE_t[:, :, :, ::1] dx_view = dx
+    cdef DTYPE_t[:, :, :, ::1] dout_view = np.ascontiguousarray(dout)
+    cdef np.uint8_t[:, :, :, ::1] argmax_uint8
+    cdef np.int32_t[:, :, :, ::1] argmax_int32
+    if argmax.dtype == np.uint8:
+        argmax_uint8 = np.ascontiguousarray(argmax)
+        with nogil:
+            max_pool_scatter_inner(dx_view, argmax_uint8, dout_view, N, C,
+                                   out_h, out_w, pool_width, stride)
+    else:
+        argmax_int32 = np.ascontiguousarray(argmax, dtype=np.int32)
+        with nogil:
+            max_pool_scatter_inner(dx_view, argmax_int32, dout_view, N, C,
+                                   out_h, out_w, pool_width, stride)
+    return dx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void max_pool_scatter_inner(DTYPE_t[:, :, :, ::1] dx,
+                                 INDEX_t[:, :, :, ::1] argmax,
+                                 DTYPE_t[:, :, :, ::1] dout,
+                                 int N, int C, int out_h, int out_w,
+                                 int pool_width, int stride) nogil:
+    cdef int nc, n, c, h, w, k
 
-    if pad > 0:
-        return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    for nc in prange(N * C, schedule='static'):
+        n = nc // C
+        c = nc % C
+        for h in range(out_h):
+            for w in range(out_w):
+                k = argmax[n, c, h, w]
+                dx[n, c, stride * h + k // pool_width,
+                   stride * w + k % pool_width] += dout[n, c, h, w]
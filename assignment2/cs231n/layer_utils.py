@@ -6,6 +6,10 @@ def affine_relu_forward(x, w, b):
   """
   Convenience layer that perorms an affine transform followed by a ReLU
 
+  The ReLU is applied in place to the output of the affine layer, and only a
+  boolean mask of the active units is kept for the backward pass instead of
+  the pre-activations, which takes an eighth of the memory.
+
   Inputs:
   - x: Input to the affine layer
   - w, b: Weights for the affine layer
@@ -14,19 +18,21 @@ def affine_relu_forward(x, w, b):
   - out: Output from the ReLU
   - cache: Object to give to the backward pass
   """
-  a, fc_cache = affine_forward(x, w, b)
-  out, relu_cache = relu_forward(a)
-  cache = (fc_cache, relu_cache)
+  out, fc_cache = affine_forward(x, w, b)
+  np.maximum(out, 0, out=out)
+  mask = out > 0
+  cache = (fc_cache, mask)
   return out, cache
 
 
-def affine_relu_backward(dout, cache):
+def affine_relu_backward(dout, cache, compute_dx=True):
   """
-  Backward pass for the affine-relu convenience layer
+  Backward pass for the affine-relu convenience layer. If compute_dx is False
+  then dx is not computed and None is returned in its place.
   """
-  fc_cache, relu_cache = cache
-  da = relu_backward(dout, relu_cache)
-  dx, dw, db = affine_backward(da, fc_cache)
+  fc_cache, mask = cache
+  da = dout * mask
+  dx, dw, db = affine_backward(da, fc_cache, compute_dx=compute_dx)
   return dx, dw, db
 
 
@@ -1,7 +1,7 @@
 import numpy as np
 
 
-def affine_forward(x, w, b):
+def affine_forward(x, w, b, out=None):
   """
   Computes the forward pass for an affine (fully-connected) layer.
 
@@ -14,65 +14,58 @@ def affine_forward(x, w, b):
   - x: A numpy array containing input data, of shape (N, d_1, ..., nk)
   - w: A numpy array of weights, of shape (D, M)
   - b: A numpy array of biases, of shape (M,)
+  - out: Optional C-contiguous array of shape (N, M) with the dtype of
+    np.dot(x, w) to write the output into, so that a caller can reuse the
+    same buffer at every step.
   
   Returns a tuple of:
   - out: output, of shape (N, M)
-  - cache: (x, w, b)
+  - cache: (x_rows, w, x_shape), where x_rows is x reshaped to (N, D)
   """
-  out = None
   #############################################################################
   # TODO: Implement the affine forward pass. Store the result in out. You     #
   # will need to reshape the input into rows.                                 #
   #############################################################################
-  D = 1
-  N = x.shape[0]
-  for index, shape in enumerate(x.shape):
-        if index == 0:
-            continue 
-        else:
-            D *= shape 
-  
-  x_flattened = x.reshape(N, D)
-  out = np.dot(x_flattened, w) + b
+  # This is a view when x is contiguous. Otherwise the copy is made once here
+  # and reused by the backward pass, instead of np.dot copying x every time.
+  x_rows = np.ascontiguousarray(x.reshape(x.shape[0], -1))
+  out = np.dot(x_rows, w, out=out)
+  out += b
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
-  cache = (x, w, b)
+  cache = (x_rows, w, x.shape)
   return out, cache
 
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, compute_dx=True):
   """
   Computes the backward pass for an affine layer.
 
   Inputs:
   - dout: Upstream derivative, of shape (N, M)
   - cache: Tuple of:
-    - x: Input data, of shape (N, d_1, ... d_k)
+    - x_rows: Input data reshaped to (N, D)
     - w: Weights, of shape (D, M)
+    - x_shape: Shape (N, d_1, ... d_k) of the input data
+  - compute_dx: If False, skip computing dx and return None in its place.
+    Use this for the first layer of a network, whose input gradient is never
+    needed; it saves one of the two matrix multiplies.
 
   Returns a tuple of:
   - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
   - dw: Gradient with respect to w, of shape (D, M)
   - db: Gradient with respect to b, of shape (M,)
   """
-  x, w, b = cache
+  x_rows, w, x_shape = cache
   dx, dw, db = None, None, None
   #############################################################################
   # TODO: Implement the affine backward pass.                                 #
   #############################################################################
-  D = 1
-  N = x.shape[0]
-  for index, shape in enumerate(x.shape):
-        if index == 0:
-            continue 
-        else:
-            D *= shape 
-            
-  dloss = 1
-  dx = np.dot(dout, w.T).reshape(x.shape)
-  db = np.sum(dout.T, axis=1)
-  dw = np.dot(x.reshape(N, D).T, dout)
+  if compute_dx:
+    dx = np.dot(dout, w.T).reshape(x_shape)
+  dw = np.dot(x_rows.T, dout)
+  db = np.sum(dout, axis=0)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -117,7 +110,7 @@ def relu_backward(dout, cache):
   #############################################################################
   # TODO: Implement the ReLU backward pass.                                   #
   #############################################################################
-  dx = (dout * (x > 0).astype(int))
+  dx = dout * (x > 0)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -185,7 +178,25 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     # the momentum variable to update the running mean and running variance,    #
     # storing your result in the running_mean and running_var variables.        #
     #############################################################################
-    pass
+    # Both moments are reduced straight from x, accumulating in float64 so
+    # that var = E[x^2] - E[x]^2 does not lose precision for float32 inputs;
+    # no centered copy of x is needed to get the variance.
+    sample_mean = x.mean(axis=0, dtype=np.float64)
+    sample_var = np.einsum('ij,ij->j', x, x, dtype=np.float64) / N
+    sample_var -= sample_mean ** 2
+    np.maximum(sample_var, 0, out=sample_var)
+    inv_std = (1.0 / np.sqrt(sample_var + eps)).astype(x.dtype)
+    sample_mean = sample_mean.astype(x.dtype)
+    sample_var = sample_var.astype(x.dtype)
+
+    x_hat = x - sample_mean
+    x_hat *= inv_std
+    out = x_hat * gamma
+    out += beta
+    cache = (x_hat, gamma, inv_std)
+
+    running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+    running_var = momentum * running_var + (1 - momentum) * sample_var
     #############################################################################
     #                             END OF YOUR CODE                              #
     #############################################################################
@@ -196,7 +207,12 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     # and shift the normalized data using gamma and beta. Store the result in   #
     # the out variable.                                                         #
     #############################################################################
-    pass
+    # Normalizing, scaling and shifting are all affine, so fold them into a
+    # single scale and shift and make one pass over x.
+    scale = (gamma / np.sqrt(running_var + eps)).astype(x.dtype)
+    shift = (beta - running_mean * scale).astype(x.dtype)
+    out = x * scale
+    out += shift
     #############################################################################
     #                             END OF YOUR CODE                              #
     #############################################################################
@@ -232,7 +248,19 @@ def batchnorm_backward(dout, cache):
   # TODO: Implement the backward pass for batch normalization. Store the      #
   # results in the dx, dgamma, and dbeta variables.                           #
   #############################################################################
-  pass
+  # Forward graph: mu = mean(x), xmu = x - mu, var = mean(xmu ** 2),
+  # inv_std = (var + eps) ** -0.5, x_hat = xmu * inv_std, out = gamma * x_hat
+  # + beta. The cache holds x_hat and inv_std, from which xmu = x_hat / inv_std.
+  x_hat, gamma, inv_std = cache
+  N = dout.shape[0]
+  dbeta = np.sum(dout, axis=0)
+  dgamma = np.sum(dout * x_hat, axis=0)
+  dx_hat = dout * gamma
+  dinv_std = np.sum(dx_hat * x_hat, axis=0) / inv_std
+  dvar = -0.5 * inv_std ** 3 * dinv_std
+  dxmu = dx_hat * inv_std + (2.0 / N) * (x_hat / inv_std) * dvar
+  dmu = -np.sum(dxmu, axis=0)
+  dx = dxmu + dmu / N
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -262,7 +290,11 @@ def batchnorm_backward_alt(dout, cache):
   # should be able to compute gradients with respect to the inputs in a       #
   # single statement; our implementation fits on a single 80-character line.  #
   #############################################################################
-  pass
+  x_hat, gamma, inv_std = cache
+  N = dout.shape[0]
+  dbeta = np.sum(dout, axis=0)
+  dgamma = np.einsum('ij,ij->j', dout, x_hat)
+  dx = (gamma * inv_std / N) * (N * dout - dbeta - x_hat * dgamma)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -270,6 +302,53 @@ def batchnorm_backward_alt(dout, cache):
   return dx, dgamma, dbeta
 
 
+def fold_batchnorm(w, b, gamma, beta, bn_param):
+  """
+  Fold a test-time batch normalization layer into the affine or convolutional
+  layer that feeds it.
+
+  At test time batch normalization computes gamma * (a - running_mean) /
+  sqrt(running_var + eps) + beta, which is an affine function of its input a.
+  Composing it with the affine map a = x.dot(w) + b (or the convolution with
+  filters w and biases b) gives another affine map, so the pair can be
+  replaced by a single layer with new weights and biases and no batch
+  normalization at all.
+
+  Inputs:
+  - w: Weights of the preceding layer, of shape (D, M) for an affine layer or
+    (M, C, HH, WW) for a convolutional layer
+  - b: Biases of the preceding layer, of shape (M,)
+  - gamma: Scale parameter of the batch normalization layer, of shape (M,)
+  - beta: Shift parameter of the batch normalization layer, of shape (M,)
+  - bn_param: The bn_param dictionary used by the batch normalization layer,
+    holding running_mean, running_var and optionally eps
+
+  Returns a tuple of:
+  - w_folded: Weights of the same shape and dtype as w
+  - b_folded: Biases of the same shape and dtype as b
+  """
+  eps = bn_param.get('eps', 1e-5)
+  scale = gamma / np.sqrt(bn_param['running_var'] + eps)
+  if w.ndim == 2:
+    w_folded = w * scale
+  else:
+    w_folded = w * scale.reshape((-1,) + (1,) * (w.ndim - 1))
+  b_folded = (b - bn_param['running_mean']) * scale + beta
+  return w_folded.astype(w.dtype), b_folded.astype(b.dtype)
+
+
+def _dropout_threshold(p):
+  """
+  Return a tuple (threshold, scale) for dropping units with probability p:
+  a unit is kept when 16 uniformly random bits are at least threshold, and
+  kept units are multiplied by scale, the inverse of the exact probability of
+  keeping a unit, so that the expected output equals the input.
+  """
+  threshold = int(round(p * 65536))
+  scale = 65536.0 / (65536 - threshold)
+  return threshold, scale
+
+
 def dropout_forward(x, dropout_param):
   """
   Performs the forward pass for (inverted) dropout.
@@ -287,7 +366,8 @@ def dropout_forward(x, dropout_param):
   Outputs:
   - out: Array of the same shape as x.
   - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-    mask that was used to multiply the input; in test mode, mask is None.
+    mask that was used to multiply the input, packed to one bit per unit with
+    np.packbits; in test mode, mask is None.
   """
   p, mode = dropout_param['p'], dropout_param['mode']
   if 'seed' in dropout_param:
@@ -301,7 +381,15 @@ def dropout_forward(x, dropout_param):
     # TODO: Implement the training phase forward pass for inverted dropout.   #
     # Store the dropout mask in the mask variable.                            #
     ###########################################################################
-    pass
+    # Draw 16 raw random bits per unit instead of a float64 uniform array;
+    # a unit is kept when its bits are at least p * 2^16. The mask is cached
+    # packed to one bit per unit.
+    threshold, scale = _dropout_threshold(p)
+    bits = np.frombuffer(np.random.bytes(2 * x.size), dtype=np.uint16)
+    keep = (bits >= threshold).reshape(x.shape)
+    out = x * keep
+    out *= scale
+    mask = np.packbits(keep)
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -309,7 +397,7 @@ def dropout_forward(x, dropout_param):
     ###########################################################################
     # TODO: Implement the test phase forward pass for inverted dropout.       #
     ###########################################################################
-    pass
+    out = x
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -336,7 +424,10 @@ def dropout_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the training phase backward pass for inverted dropout.  #
     ###########################################################################
-    pass
+    _, scale = _dropout_threshold(dropout_param['p'])
+    keep = np.unpackbits(mask)[:dout.size].reshape(dout.shape)
+    dx = dout * keep
+    dx *= scale
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -345,10 +436,35 @@ def dropout_backward(dout, cache):
   return dx
 
 
+def _windows(x, field_height, field_width, stride):
+  """
+  Return a view of x of shape (N, C, H', W', field_height, field_width) where
+  [:, :, i, j] is the field_height x field_width window of x whose top-left
+  corner is at (i * stride, j * stride). No data is copied.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - field_height, field_width: Size of each window
+  - stride: Distance between adjacent windows
+  """
+  N, C, H, W = x.shape
+  out_h = (H - field_height) // stride + 1
+  out_w = (W - field_width) // stride + 1
+  s0, s1, s2, s3 = x.strides
+  return np.lib.stride_tricks.as_strided(x,
+             shape=(N, C, out_h, out_w, field_height, field_width),
+             strides=(s0, s1, stride * s2, stride * s3, s2, s3))
+
+
 def conv_forward_naive(x, w, b, conv_param):
   """
   A naive implementation of the forward pass for a convolutional layer.
 
+  This only needs numpy: the padded input is viewed as a grid of receptive
+  fields with np.lib.stride_tricks and contracted with the filters using
+  np.tensordot, so it is fast enough to train small CNNs on machines where the
+  Cython extension used by fast_layers cannot be built.
+
   The input consists of N data points, each with C channels, height H and width
   W. We convolve each input with F different filters, where each filter spans
   all C channels and has height HH and width HH.
@@ -373,7 +489,16 @@ def conv_forward_naive(x, w, b, conv_param):
   # TODO: Implement the convolutional forward pass.                           #
   # Hint: you can use the function np.pad for padding.                        #
   #############################################################################
-  pass
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+
+  # Every receptive field is a window of the padded input, so the whole
+  # convolution is one tensor contraction over (C, HH, WW).
+  windows = _windows(x_padded, HH, WW, stride)
+  out = np.tensordot(windows, w, axes=([1, 4, 5], [1, 2, 3]))
+  out = np.ascontiguousarray(out.transpose(0, 3, 1, 2))
+  out += b.reshape(F, 1, 1)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -398,7 +523,27 @@ def conv_backward_naive(dout, cache):
   #############################################################################
   # TODO: Implement the convolutional backward pass.                          #
   #############################################################################
-  pass
+  x, w, b, conv_param = cache
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  windows = _windows(x_padded, HH, WW, stride)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.tensordot(dout, windows, axes=([0, 2, 3], [0, 2, 3]))
+
+  # Gradient of every window, of shape (N, out_h, out_w, C, HH, WW). Each
+  # filter tap (i, j) touches a strided grid of the padded input, so the
+  # windows are summed back with one strided add per tap.
+  dwindows = np.tensordot(dout, w, axes=([1], [0]))
+  dx_padded = np.zeros_like(x_padded)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      dx_padded[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += \
+          dwindows[:, :, :, :, i, j].transpose(0, 3, 1, 2)
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -424,7 +569,9 @@ def max_pool_forward_naive(x, pool_param):
   #############################################################################
   # TODO: Implement the max pooling forward pass                              #
   #############################################################################
-  pass
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out = _windows(x, pool_height, pool_width, stride).max(axis=(4, 5))
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -447,13 +594,113 @@ def max_pool_backward_naive(dout, cache):
   #############################################################################
   # TODO: Implement the max pooling backward pass                             #
   #############################################################################
-  pass
+  x, pool_param = cache
+  N, C, H, W = x.shape
+  _, _, out_h, out_w = dout.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  # Position of the (first) maximum within each pooling window
+  windows = _windows(x, pool_height, pool_width, stride)
+  argmax = windows.reshape(N, C, out_h, out_w, -1).argmax(axis=4)
+
+  # Route each upstream gradient to its argmax, one strided add per window
+  # offset; overlapping windows accumulate.
+  dx = np.zeros_like(x)
+  for i in xrange(pool_height):
+    for j in xrange(pool_width):
+      dx[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += \
+          dout * (argmax == i * pool_width + j)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
   return dx
 
 
+def avg_pool_forward_naive(x, pool_param):
+  """
+  A naive implementation of the forward pass for an average pooling layer.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+  - pool_param: dictionary with the following keys:
+    - 'pool_height': The height of each pooling region
+    - 'pool_width': The width of each pooling region
+    - 'stride': The distance between adjacent pooling regions
+
+  Returns a tuple of:
+  - out: Output data
+  - cache: (x.shape, pool_param)
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out = _windows(x, pool_height, pool_width, stride).mean(axis=(4, 5))
+  cache = (x.shape, pool_param)
+  return out, cache
+
+
+def avg_pool_backward_naive(dout, cache):
+  """
+  A naive implementation of the backward pass for an average pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives
+  - cache: A tuple of (x.shape, pool_param) as in the forward pass.
+
+  Returns:
+  - dx: Gradient with respect to x
+  """
+  x_shape, pool_param = cache
+  _, _, out_h, out_w = dout.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  # Every element of a pooling region gets an equal share of its gradient
+  dout_share = dout / float(pool_height * pool_width)
+  dx = np.zeros(x_shape, dtype=dout.dtype)
+  for i in xrange(pool_height):
+    for j in xrange(pool_width):
+      dx[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += \
+          dout_share
+  return dx
+
+
+def global_avg_pool_forward(x):
+  """
+  Computes the forward pass for a global average pooling layer, which
+  averages each channel over all spatial positions. An affine layer after it
+  has C inputs instead of C * H * W, so it needs H * W times fewer weights.
+
+  Inputs:
+  - x: Input data, of shape (N, C, H, W)
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, C)
+  - cache: x.shape
+  """
+  N, C, H, W = x.shape
+  out = x.reshape(N, C, H * W).mean(axis=2)
+  cache = x.shape
+  return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+  """
+  Computes the backward pass for a global average pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, C)
+  - cache: x.shape from the forward pass.
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, C, H, W)
+  """
+  N, C, H, W = cache
+  dx = np.empty(cache, dtype=dout.dtype)
+  dx[...] = (dout / float(H * W))[:, :, np.newaxis, np.newaxis]
+  return dx
+
+
 def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   """
   Computes the forward pass for spatial batch normalization.
@@ -485,7 +732,46 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  pass
+  # Rather than transposing x to (N * H * W, C) for the vanilla layer, reduce
+  # over the axes (0, 2, 3) directly and broadcast per-channel values with
+  # shape (1, C, 1, 1), so x is never copied into another layout.
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+
+  N, C, H, W = x.shape
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+
+  if mode == 'train':
+    M = N * H * W
+    sample_mean = x.mean(axis=(0, 2, 3), dtype=np.float64)
+    sample_var = np.einsum('nchw,nchw->c', x, x, dtype=np.float64) / M
+    sample_var -= sample_mean ** 2
+    np.maximum(sample_var, 0, out=sample_var)
+    inv_std = (1.0 / np.sqrt(sample_var + eps)).astype(x.dtype)
+    sample_mean = sample_mean.astype(x.dtype)
+    sample_var = sample_var.astype(x.dtype)
+
+    x_hat = x - sample_mean.reshape(1, C, 1, 1)
+    x_hat *= inv_std.reshape(1, C, 1, 1)
+    out = x_hat * gamma.reshape(1, C, 1, 1)
+    out += beta.reshape(1, C, 1, 1)
+    cache = (x_hat, gamma, inv_std)
+
+    running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+    running_var = momentum * running_var + (1 - momentum) * sample_var
+  elif mode == 'test':
+    scale = (gamma / np.sqrt(running_var + eps)).astype(x.dtype)
+    shift = (beta - running_mean * scale).astype(x.dtype)
+    out = x * scale.reshape(1, C, 1, 1)
+    out += shift.reshape(1, C, 1, 1)
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  # Store the updated running means back into bn_param
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -515,7 +801,17 @@ def spatial_batchnorm_backward(dout, cache):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  pass
+  # Same closed form as batchnorm_backward_alt, with every example reduced
+  # over its N * H * W positions per channel.
+  x_hat, gamma, inv_std = cache
+  N, C, H, W = dout.shape
+  M = N * H * W
+  dbeta = np.sum(dout, axis=(0, 2, 3))
+  dgamma = np.einsum('nchw,nchw->c', dout, x_hat)
+  dx = x_hat * dgamma.reshape(1, C, 1, 1)
+  dx += dbeta.reshape(1, C, 1, 1)
+  np.subtract(M * dout, dx, out=dx)
+  dx *= (gamma * inv_std / M).reshape(1, C, 1, 1)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -523,7 +819,7 @@ def spatial_batchnorm_backward(dout, cache):
   return dx, dgamma, dbeta
   
 
-def svm_loss(x, y):
+def svm_loss(x, y, out=None):
   """
   Computes the loss and gradient using for multiclass SVM classification.
 
@@ -532,25 +828,32 @@ def svm_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - out: Optional array of the same shape and dtype as x that is used as the
+    workspace and receives dx. Passing the same array at every step avoids
+    allocating anything of size (N, C).
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
   N = x.shape[0]
-  correct_class_scores = x[np.arange(N), y]
-  margins = np.maximum(0, x - correct_class_scores[:, np.newaxis] + 1.0)
-  margins[np.arange(N), y] = 0
-  loss = np.sum(margins) / N
-  num_pos = np.sum(margins > 0, axis=1)
-  dx = np.zeros_like(x)
-  dx[margins > 0] = 1
-  dx[np.arange(N), y] -= num_pos
+  rows = np.arange(N)
+  correct_class_scores = x[rows, y]
+  # The margins are built in the output buffer and then turned into the
+  # gradient in place: each positive margin contributes 1, and the correct
+  # class gets minus the number of positive margins.
+  dx = np.subtract(x, correct_class_scores[:, np.newaxis], out=out)
+  dx += 1.0
+  np.maximum(dx, 0, out=dx)
+  dx[rows, y] = 0
+  loss = np.sum(dx) / N
+  np.sign(dx, out=dx)
+  dx[rows, y] = -np.sum(dx, axis=1)
   dx /= N
   return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, out=None):
   """
   Computes the loss and gradient for softmax classification.
 
@@ -559,16 +862,26 @@ def softmax_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - out: Optional array of the same shape and dtype as x that is used as the
+    workspace and receives dx. Passing the same array at every step avoids
+    allocating anything of size (N, C).
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
-  probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
   N = x.shape[0]
-  loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-  dx = probs.copy()
-  dx[np.arange(N), y] -= 1
+  rows = np.arange(N)
+  # With shifted = x - max(x), the loss of each example is
+  # log(sum(exp(shifted))) - shifted[y] (log-sum-exp), which never takes the
+  # log of an underflowed probability. The probabilities for the gradient
+  # are computed in place in the output buffer.
+  dx = np.subtract(x, np.max(x, axis=1, keepdims=True), out=out)
+  correct_shifted = dx[rows, y]
+  np.exp(dx, out=dx)
+  sums = np.sum(dx, axis=1, keepdims=True)
+  loss = np.sum(np.log(sums)) / N - np.sum(correct_shifted) / N
+  dx /= sums
+  dx[rows, y] -= 1
   dx /= N
   return loss, dx
@@ -1,11 +1,22 @@
+import sys
+
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# The kernels run in parallel with OpenMP. Apple's compiler does not support
+# -fopenmp, so on OS X they are built without it and run serially.
+if sys.platform == 'darwin':
+  openmp_args = []
+else:
+  openmp_args = ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = openmp_args,
+            extra_link_args = openmp_args,
   ),
 ]
 
@@ -1,6 +1,7 @@
 import numpy as np
 
 from cs231n import optim
+from cs231n.data_loader import DataLoader
 
 
 class Solver(object):
@@ -32,6 +33,7 @@ class Solver(object):
     'y_train': # training labels
     'X_val': # validation data
     'X_train': # validation labels
+    'mean_image': # optional; see below
   }
   model = MyAwesomeModel(hidden_size=100, reg=10)
   solver = Solver(model, data,
@@ -82,6 +84,11 @@ class Solver(object):
       'X_val': Array of shape (N_val, d_1, ..., d_k) giving validation images
       'y_train': Array of shape (N_train,) giving labels for training images
       'y_val': Array of shape (N_val,) giving labels for validation images
+      It may also contain:
+      'mean_image': Array of shape (d_1, ..., d_k). If present, X_train and
+        X_val hold raw pixels (such as uint8 arrays) and each minibatch is
+        converted to float32 and centered by subtracting mean_image just
+        before it is given to the model.
       
     Optional arguments:
     - update_rule: A string giving the name of an update rule in optim.py.
@@ -99,12 +106,18 @@ class Solver(object):
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
       training.
+    - transform: A function used to augment each training minibatch in
+      place, such as an Augmenter from augment.py. Default is None.
+    - data_loader: A DataLoader producing training minibatches. By default
+      one is built from X_train and y_train that shuffles every epoch and
+      prefetches minibatches in a background thread.
     """
     self.model = model
     self.X_train = data['X_train']
     self.y_train = data['y_train']
     self.X_val = data['X_val']
     self.y_val = data['y_val']
+    self.mean_image = data.get('mean_image')
     
     # Unpack keyword arguments
     self.update_rule = kwargs.pop('update_rule', 'sgd')
@@ -115,6 +128,8 @@ class Solver(object):
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
+    self.transform = kwargs.pop('transform', None)
+    self.data_loader = kwargs.pop('data_loader', None)
 
     # Throw an error if there are extra keyword arguments
     if len(kwargs) > 0:
@@ -127,6 +142,12 @@ class Solver(object):
       raise ValueError('Invalid update_rule "%s"' % self.update_rule)
     self.update_rule = getattr(optim, self.update_rule)
 
+    if self.data_loader is None:
+      self.data_loader = DataLoader(self.X_train, self.y_train,
+                                    batch_size=self.batch_size,
+                                    mean=self.mean_image,
+                                    transform=self.transform)
+
     self._reset()
 
 
@@ -155,11 +176,8 @@ class Solver(object):
     Make a single gradient update. This is called by train() and should not
     be called manually.
     """
-    # Make a minibatch of training data
-    num_train = self.X_train.shape[0]
-    batch_mask = np.random.choice(num_train, self.batch_size)
-    X_batch = self.X_train[batch_mask]
-    y_batch = self.y_train[batch_mask]
+    # Get the next minibatch of training data
+    X_batch, y_batch = self.data_loader.next()
 
     # Compute loss and gradient
     loss, grads = self.model.loss(X_batch, y_batch)
@@ -207,7 +225,10 @@ class Solver(object):
     for i in xrange(num_batches):
       start = i * batch_size
       end = (i + 1) * batch_size
-      scores = self.model.loss(X[start:end])
+      X_batch = X[start:end]
+      if self.mean_image is not None:
+        X_batch = np.subtract(X_batch, self.mean_image, dtype=np.float32)
+      scores = self.model.loss(X_batch)
       y_pred.append(np.argmax(scores, axis=1))
     y_pred = np.hstack(y_pred)
     acc = np.mean(y_pred == y)
@@ -219,47 +240,50 @@ class Solver(object):
     """
     Run optimization to train the model.
     """
-    num_train = self.X_train.shape[0]
-    iterations_per_epoch = max(num_train / self.batch_size, 1)
+    iterations_per_epoch = self.data_loader.num_batches
     num_iterations = self.num_epochs * iterations_per_epoch
 
-    for t in xrange(num_iterations):
-      self._step()
-
-      # Maybe print training loss
-      if self.verbose and t % self.print_every == 0:
-        print '(Iteration %d / %d) loss: %f' % (
-               t + 1, num_iterations, self.loss_history[-1])
-
-      # At the end of every epoch, increment the epoch counter and decay the
-      # learning rate.
-      epoch_end = (t + 1) % iterations_per_epoch == 0
-      if epoch_end:
-        self.epoch += 1
-        for k in self.optim_configs:
-          self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-      # Check train and val accuracy on the first iteration, the last
-      # iteration, and at the end of each epoch.
-      first_it = (t == 0)
-      last_it = (t == num_iterations + 1)
-      if first_it or last_it or epoch_end:
-        train_acc = self.check_accuracy(self.X_train, self.y_train,
-                                        num_samples=1000)
-        val_acc = self.check_accuracy(self.X_val, self.y_val)
-        self.train_acc_history.append(train_acc)
-        self.val_acc_history.append(val_acc)
-
-        if self.verbose:
-          print '(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                 self.epoch, self.num_epochs, train_acc, val_acc)
-
-        # Keep track of the best model
-        if val_acc > self.best_val_acc:
-          self.best_val_acc = val_acc
-          self.best_params = {}
-          for k, v in self.model.params.iteritems():
-            self.best_params[k] = v.copy()
+    try:
+      for t in xrange(num_iterations):
+        self._step()
+
+        # Maybe print training loss
+        if self.verbose and t % self.print_every == 0:
+          print '(Iteration %d / %d) loss: %f' % (
+                 t + 1, num_iterations, self.loss_history[-1])
+
+        # At the end of every epoch, increment the epoch counter and decay the
+        # learning rate.
+        epoch_end = (t + 1) % iterations_per_epoch == 0
+        if epoch_end:
+          self.epoch += 1
+          for k in self.optim_configs:
+            self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+        # Check train and val accuracy on the first iteration, the last
+        # iteration, and at the end of each epoch.
+        first_it = (t == 0)
+        last_it = (t == num_iterations + 1)
+        if first_it or last_it or epoch_end:
+          train_acc = self.check_accuracy(self.X_train, self.y_train,
+                                          num_samples=1000)
+          val_acc = self.check_accuracy(self.X_val, self.y_val)
+          self.train_acc_history.append(train_acc)
+          self.val_acc_history.append(val_acc)
+
+          if self.verbose:
+            print '(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+                   self.epoch, self.num_epochs, train_acc, val_acc)
+
+          # Keep track of the best model
+          if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            self.best_params = {}
+            for k, v in self.model.params.iteritems():
+              self.best_params[k] = v.copy()
+    finally:
+      # Stop prefetching minibatches, also if training is interrupted
+      self.data_loader.close()
 
     # At the end of training swap the best params into the model
     self.model.params = self.best_params